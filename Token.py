@@ -72,15 +72,26 @@ class Token(object):
                  'sig': self.sig.decode('utf-8').replace("'", '"'), 'timestamp': self.timestamp}
             return d
 
-    def verify(self):
+    def get_signature(self):
+        """
+        Gets the signature of the Token in the form that is checked by a SignatureVerifier.
+        :return: (public key, signature, message) tuple
+        """
+        return self.voter_address, self.sig, self.get_signing_data().encode()
+
+    def verify(self, check_signature=True):
         """
         Verifies the Token
+        :param check_signature: Bool - False if the signature is checked separately, with the rest of a block's
+        signatures
         :return: Bool
         """
         if self.ans == '':  # Checks that there is a vote
             return False
         if self.sig == '':  # Checks that there is a signature
             return False
+        if not check_signature:
+            return True
         vk = ecdsa.VerifyingKey.from_string((bytes.fromhex(self.voter_address)), curve=ecdsa.SECP256k1)
 
         try:
@@ -7,6 +7,7 @@ from kivy.uix.boxlayout import BoxLayout
 from kivy.uix.label import Label
 from kivy.properties import NumericProperty, ObjectProperty, StringProperty, ColorProperty, BooleanProperty
 from kivy.uix.screenmanager import Screen, ScreenManager, NoTransition
+from kivy.clock import Clock
 
 from wallet import Wallet
 from handler import NodeHandler
@@ -778,6 +779,7 @@ class VoterApp(App):  # Class that represents the overall application
     status = StringProperty('Connecting')
     connections = StringProperty('0')
     blockheight = StringProperty('10')
+    sync_progress = StringProperty('Up to date')
     mining_txt = StringProperty()
 
     # Network attributes
@@ -787,6 +789,9 @@ class VoterApp(App):  # Class that represents the overall application
     sent = StringProperty()
     received = StringProperty()
     last_node = StringProperty()
+    send_queue = StringProperty('0')
+    seen_cache = StringProperty('0')
+    signature_cache = StringProperty('0')
 
     # Dashboard attributes
     address = StringProperty()
@@ -801,6 +806,12 @@ class VoterApp(App):  # Class that represents the overall application
     submitted_votes = StringProperty()
     confirmed_votes = StringProperty()
 
+    # Mining attributes
+    hashrate = StringProperty('0 H/s')
+    nonces_tried = StringProperty('0')
+    block_time = StringProperty('0.0 s')
+    aborted_blocks = StringProperty('0')
+
     console = StringProperty()
 
     def __init__(self, path):
@@ -842,12 +853,16 @@ class VoterApp(App):  # Class that represents the overall application
 
     def on_start(self):
         self.handler.start_node()
+        Clock.schedule_interval(self.update_mining_stats, 1)
+        Clock.schedule_interval(self.update_network_stats, 1)
 
     def on_stop(self):
         self.mining = False
         self.mining_txt = 'False'
         if self.handler.blockchain.mining:  # Stops the device from mining
             self.handler.blockchain.stop_mining()
+        self.handler.blockchain.mining_engine.shutdown()  # Stops the mining processes
+        self.handler.blockchain.verifier.shutdown()  # Stops the signature verification processes
         if self.handler is not None:
             self.handler.stop_node()  # Closes all sockets
 
@@ -876,6 +891,24 @@ class VoterApp(App):  # Class that represents the overall application
         self.last_block = str(self.handler.blockchain.get_last_block().hash)
         self.update_wallet()
 
+    def update_mining_stats(self, dt=None):  # Called every second so the hashrate is live
+        stats = self.handler.blockchain.mining_stats
+        stats.sample()
+        self.hashrate = str(int(stats.hashrate)) + ' H/s'
+        self.nonces_tried = str(stats.get_nonces_tried())
+        self.block_time = '{:.1f} s'.format(stats.last_block_time)
+        self.aborted_blocks = str(stats.aborted_blocks)
+
+    def update_network_stats(self, dt=None):  # Called every second so the send queues and caches are live
+        stats = self.handler.node.get_queue_stats()
+        self.send_queue = '{} ({} KB, {} dropped)'.format(stats['depth'], stats['bytes'] // 1024, stats['dropped'])
+        if stats['dropped_kinds']:
+            self.send_queue += ': ' + ', '.join([k + ' ' + str(v) for k, v in sorted(stats['dropped_kinds'].items())])
+        stats = self.handler.seen.get_stats()
+        self.seen_cache = '{:.0%} hits ({} duplicates)'.format(stats['hit_rate'], stats['hits'])
+        stats = self.handler.blockchain.verifier.get_stats()
+        self.signature_cache = '{:.0%} hits ({} checks saved)'.format(stats['hit_rate'], stats['hits'])
+
     def update_wallet(self):
         if self.handler.blockchain.wallet is not None:
             self.empty_tokens = str(self.wallet.empty_tks)
@@ -0,0 +1,413 @@
+"""
+Benchmarks for the parts of the project where performance matters.
+
+Run every benchmark with: python benchmarks.py
+Or run some of them with: python benchmarks.py codec ...
+"""
+
+import ast
+import base64
+import contextlib
+import io
+import json
+import sys
+import tempfile
+import time
+
+import ecdsa
+
+from block import Block
+from codec import encode_value, decode_value
+from database_manager import BlockchainDatabase
+from Token import Token
+from transaction import Transaction
+from verification import SignatureVerifier
+
+
+def timed(function, repeats):
+    """
+    Times how long a function takes to run a number of times.
+    :param function: Function that takes no arguments
+    :param repeats: int
+    :return: float - Seconds
+    """
+    start = time.perf_counter()
+    for _ in range(repeats):
+        function()
+    return time.perf_counter() - start
+
+
+def report(name, repeats, seconds, unit='ops'):
+    """
+    Prints the result of a benchmark.
+    :param name: string
+    :param repeats: int
+    :param seconds: float
+    :param unit: string
+    :return: None
+    """
+    print('{:<48} {:>12,.0f} {}/s'.format(name, repeats / seconds, unit))
+
+
+def example_token(signed=True):
+    """
+    Creates the dictionary form of a token, as stored in the value of a type 1 or type 2 output.
+    :param signed: Bool
+    :return: dict
+    """
+    return {'tkid': '7004c656e1ef1429', 'poll_address': '03' + 'ab' * 32, 'voter_address': '02' + 'cd' * 32,
+            'question': 'Which option do you prefer?', 'options': [['1', 'First'], ['2', 'Second'], ['3', 'Third']],
+            'ans': 1 if signed else '', 'sig': base64.b64encode(bytes(64)) if signed else '',
+            'timestamp': 1792219578757060711}
+
+
+def benchmark_value_decoding(n=20000):
+    """
+    Compares decoding token-bearing output values stored with str() against the codec module.
+    :param n: int - Number of values decoded
+    :return: None
+    """
+    print('Decoding token values (' + str(n) + ' values)')
+    legacy = str(example_token())
+    encoded = encode_value(example_token())
+    assert eval(legacy) == decode_value(encoded) == decode_value(legacy)
+
+    report('  eval(str(value))  (before)', n, timed(lambda: eval(legacy), n), 'values')
+    report('  ast.literal_eval  (legacy rows)', n, timed(lambda: ast.literal_eval(legacy), n), 'values')
+    report('  codec.decode_value (after)', n, timed(lambda: decode_value(encoded), n), 'values')
+
+
+def example_block(height, previous_hash, n=64):
+    """
+    Creates a block of transactions that each spend one output and create two.
+    :param height: int
+    :param previous_hash: string
+    :param n: int - Number of transactions
+    :return: Block
+    """
+    transactions = []
+    for i in range(n):
+        tx = Transaction(0, 3, '02' + 'ab' * 32, '03' + 'cd' * 32)
+        sig = base64.b64encode(bytes(64))
+        tx.inputs = [{'txid': str(height) + '-' + str(i), 'index': 0, 'value': 5, 'recipient': tx.from_address,
+                      'sig': sig, 'type': 0}]
+        tx.outputs = [{'txid': tx.txid, 'index': j, 'value': v, 'recipient': r, 'sig': sig, 'type': 0}
+                      for j, (v, r) in enumerate([[3, tx.to_address[0]], [2, tx.from_address]])]
+        tx.to_address = [o['recipient'] for o in tx.outputs]  # As the wallet does when it adds the change output
+        transactions.append(tx)
+    return Block(previous_hash, transactions, 1, height)
+
+
+def add_block_per_row(database, block):
+    """
+    Stores a block the way add_block did before, committing after every row.
+    :param database: BlockchainDatabase
+    :param block: Block
+    :return: None
+    """
+    db, cursor = database.db, database.cursor
+    cursor.execute('INSERT INTO Blocks (hash, previous_hash, timestamp, difficulty, nonce, height, version, '
+                   'merkle_root) VALUES (?,?,?,?,?,?,?,?)', [block.hash, block.previous_hash, block.timestamp,
+                                                            block.difficulty, block.nonce, block.height,
+                                                            block.version, block.merkle_root])
+    db.commit()
+    for tx in block.transactions:
+        for i in tx.inputs:
+            cursor.execute('UPDATE Outputs SET utxo = FALSE WHERE txid = ? AND ind = ?', [i['txid'], i['index']])
+            db.commit()
+    for tx in block.transactions:
+        cursor.execute('INSERT INTO Transactions VALUES (?,?,?,?,?,?)',
+                       [tx.txid, block.hash, tx.type, encode_value(tx.value), tx.from_address, tx.timestamp])
+        db.commit()
+        for i in tx.inputs:
+            cursor.execute('INSERT INTO Inputs VALUES (?,?,?,?,?,?,?)', [tx.txid, i['txid'], i['index'],
+                                                                         encode_value(i['value']), i['recipient'],
+                                                                         i['sig'], i['type']])
+            db.commit()
+        for o in tx.outputs:
+            cursor.execute('INSERT INTO Outputs VALUES (?,?,?,?,?,?,?)', [o['txid'], o['index'],
+                                                                          encode_value(o['value']), o['recipient'],
+                                                                          o['sig'], True, o['type']])
+            db.commit()
+
+
+def benchmark_block_persistence(n=20):
+    """
+    Compares storing 64-transaction blocks with a commit per row, using the journal settings the database had before,
+    against storing each block in one transaction, using the current settings.
+    :param n: int - Number of blocks stored
+    :return: None
+    """
+    print('Storing blocks of 64 transactions (' + str(n) + ' blocks)')
+    for name, add, before in [['  commit per row, DELETE journal (before)', add_block_per_row, True],
+                              ['  one transaction, WAL journal   (after)', BlockchainDatabase.add_block, False]]:
+        with tempfile.TemporaryDirectory() as folder:
+            database = BlockchainDatabase(None, folder)
+            if before:  # SQLite's defaults, which the database used before it was switched to WAL
+                database.cursor.execute('PRAGMA journal_mode = DELETE')
+                database.cursor.execute('PRAGMA synchronous = FULL')
+            blocks = []
+            for height in range(1, n + 1):
+                blocks.append(example_block(height, blocks[-1].hash if blocks else '0' * 64))
+            blocks = iter(blocks)
+            report(name, n, timed(lambda: add(database, next(blocks)), n), 'blocks')
+            database.close()
+
+
+def fill_database(database, n):
+    """
+    Fills a database with n outputs, in transactions of 2 outputs and blocks of 64 transactions.
+    Outputs belong to 1000 addresses, and every fourth transaction is a confirmed vote.
+    :param database: BlockchainDatabase
+    :param n: int - Number of outputs
+    :return: None
+    """
+    blocks, transactions, outputs = [], [], []
+    for t in range(n // 2):
+        if t % 64 == 0:
+            blocks.append(['b' + str(t // 64), 'b' + str(t // 64 - 1), t, 1, 0, t // 64, 4, '0' * 64, None, None])
+        txid = 't' + str(t)
+        ty = 2 if t % 4 == 0 else 0
+        transactions.append([txid, blocks[-1][0], ty, encode_value(1), 'a' + str(t % 1000), t])
+        for i in range(2):
+            outputs.append([txid, i, encode_value(1), 'a' + str((t + i) % 1000), '', t % 3 != 0, ty])
+
+    with database.db:
+        database.cursor.executemany('INSERT INTO Blocks VALUES (?,?,?,?,?,?,?,?,?,?)', blocks)
+        database.cursor.executemany('INSERT INTO Transactions VALUES (?,?,?,?,?,?)', transactions)
+        database.cursor.executemany('INSERT INTO Outputs VALUES (?,?,?,?,?,?,?)', outputs)
+
+
+def benchmark_database_queries(sizes=(10000, 100000, 1000000)):
+    """
+    Compares the latency of the database's lookups without and with the indexes added by the add_indexes migration.
+    :param sizes: Tuple of ints - Numbers of outputs in the database
+    :return: None
+    """
+    queries = [['get_tokens', lambda d: d.get_tokens('a7', 0)],
+               ['get_utxos', lambda d: d.get_utxos('a7', 0)],
+               ['get_confirmed_votes', lambda d: d.get_confirmed_votes('a8')],
+               ['block_from_height', lambda d: d.block_from_height(4)]]
+    for n in sizes:
+        print('Database queries (' + '{:,}'.format(n) + ' outputs)')
+        with tempfile.TemporaryDirectory() as folder:
+            database = BlockchainDatabase(None, folder)
+            fill_database(database, n)
+            indexes = database.cursor.execute("SELECT name, sql FROM sqlite_master WHERE type = 'index' AND "
+                                              "sql IS NOT NULL").fetchall()
+            for state in ['no indexes', 'indexes']:
+                for name, sql in indexes:
+                    database.cursor.execute('DROP INDEX ' + name if state == 'no indexes' else sql)
+                repeats = 1000 if state == 'indexes' else max(2, 2000000 // n)
+                for name, query in queries:
+                    report('  {:<20} ({})'.format(name, state), repeats, timed(lambda: query(database), repeats),
+                           'queries')
+            database.close()
+
+
+def get_blocks_per_transaction(database, first, last):
+    """
+    Creates blocks the way block_from_height did before, with a few queries for each transaction.
+    :param database: BlockchainDatabase
+    :param first: int
+    :param last: int
+    :return: List of Blocks
+    """
+    chain = []
+    for h in range(first, last + 1):
+        database.cursor.execute('SELECT txid FROM Transactions INNER JOIN Blocks ON Blocks.hash = '
+                                'Transactions.block_hash WHERE height = ?', [h])
+        txs = [database.create_transaction(txid[0]) for txid in database.cursor.fetchall()]
+        database.cursor.execute('SELECT difficulty, nonce, hash, timestamp, previous_hash, version FROM Blocks '
+                                'WHERE height = ?', [h])
+        r = database.cursor.fetchall()[0]
+        b = Block(r[4], txs, r[0], h, version=r[5])
+        b.nonce, b.hash, b.timestamp = r[1], r[2], r[3]
+        chain.append(b)
+    return chain
+
+
+def benchmark_block_loading(n=16, repeats=20):
+    """
+    Compares creating the blocks kept in memory with queries for each transaction against get_blocks.
+    :param n: int - Number of 64-transaction blocks loaded
+    :param repeats: int
+    :return: None
+    """
+    print('Loading ' + str(n) + ' blocks of 64 transactions')
+    with tempfile.TemporaryDirectory() as folder:
+        database = BlockchainDatabase(None, folder)
+        previous_hash = '0' * 64
+        for height in range(n):
+            block = example_block(height, previous_hash)
+            database.add_block(block)
+            previous_hash = block.hash
+
+        assert [b.merkle_root for b in database.get_blocks(0, n - 1)] == \
+               [b.merkle_root for b in get_blocks_per_transaction(database, 0, n - 1)]
+        report('  queries per transaction (before)', repeats * n,
+               timed(lambda: get_blocks_per_transaction(database, 0, n - 1), repeats), 'blocks')
+        report('  get_blocks (after)', repeats * n, timed(lambda: database.get_blocks(0, n - 1), repeats), 'blocks')
+        database.close()
+
+
+def benchmark_block_serving(n=8, repeats=20):
+    """
+    Compares building a reply to get_blocks from the database against reading the blocks from the block file.
+    :param n: int - Number of 64-transaction blocks in a reply
+    :param repeats: int
+    :return: None
+    """
+    print('Replying to get_blocks with ' + str(n) + ' blocks of 64 transactions')
+    with tempfile.TemporaryDirectory() as folder:
+        database = BlockchainDatabase(None, folder)
+        previous_hash = '0' * 64
+        for height in range(n):
+            block = example_block(height, previous_hash)
+            database.add_block(block)
+            previous_hash = block.hash
+
+        rebuilt = lambda: json.dumps({'blocks': [b.get_sending_form() for b in database.get_blocks(0, n - 1)]})
+        raw = lambda: b'{"blocks": [' + b', '.join(database.get_raw_blocks(0, n - 1)) + b']}'
+        assert json.loads(rebuilt()) == json.loads(raw())
+        report('  rebuild and encode (before)', repeats * n, timed(rebuilt, repeats), 'blocks')
+        report('  block file (after)', repeats * n, timed(raw, repeats), 'blocks')
+        database.close()
+
+
+def signed_vote_block(n=64):
+    """
+    Creates a block of votes that are signed the way the wallet signs them, each with a token and an output signature.
+    :param n: int - Number of votes
+    :return: Block
+    """
+    transactions = []
+    for i in range(n):
+        sk = ecdsa.SigningKey.generate(curve=ecdsa.SECP256k1)
+        address = sk.get_verifying_key().to_string('compressed').hex()
+        tk = Token('03' + 'ab' * 32, address, 'Which option do you prefer?', [['1', 'First'], ['2', 'Second']], a=1)
+        tk.sig = base64.b64encode(sk.sign(tk.get_signing_data().encode()))
+        tx = Transaction(2, tk.get_dictionary_form(), address, tk.poll_address)
+        tx.inputs = [{'txid': 'v' + str(i), 'index': 0, 'value': tx.value, 'recipient': address, 'sig': None,
+                      'type': 1}]
+        tx.create_outputs()
+        for output, string in zip(tx.outputs, tx.get_outputs()):
+            output['sig'] = base64.b64encode(sk.sign(string.encode()))
+        transactions.append(tx)
+    return Block('0' * 64, transactions, 1, 1)
+
+
+def benchmark_signature_verification(n=64, repeats=3, workers=(1, 2, 4, 8)):
+    """
+    Compares checking a block's signatures one transaction at a time against a SignatureVerifier with a number of
+    worker processes.
+    :param n: int - Number of votes in the block, each with two signatures
+    :param repeats: int
+    :param workers: Tuple of ints - Numbers of worker processes
+    :return: None
+    """
+    block = signed_vote_block(n)
+    signatures = sum(len(tx.prepare_verification()) for tx in block.transactions)
+    print('Verifying a block of ' + str(n) + ' votes (' + str(signatures) + ' signatures)')
+    with contextlib.redirect_stdout(io.StringIO()):  # Token.verify prints every token it checks
+        assert block.validate_transactions()
+        seconds = timed(block.validate_transactions, repeats)
+    report('  Transaction.verify (before)', repeats * signatures, seconds, 'signatures')
+
+    for w in workers:
+        verifier = SignatureVerifier(w, cache_size=0)  # Without the cache, so every repeat checks every signature
+        verifier.start()
+        assert block.validate_transactions(verifier)  # The workers are started before they are timed
+        report('  SignatureVerifier, {} workers'.format(w), repeats * signatures,
+               timed(lambda: block.validate_transactions(verifier), repeats), 'signatures')
+        verifier.shutdown()
+
+
+def benchmark_signature_cache(n=64, repeats=3):
+    """
+    Compares validating a block of votes that haven't been seen before against one whose transactions were checked
+    when they entered the memory pool.
+    :param n: int - Number of votes in the block, each with two signatures
+    :param repeats: int
+    :return: None
+    """
+    block = signed_vote_block(n)
+    print('Validating a block of ' + str(n) + ' votes')
+    seconds = 0
+    for _ in range(repeats):
+        verifier = SignatureVerifier(1)
+        seconds += timed(lambda: block.validate_transactions(verifier), 1)
+    report('  signatures not cached (before)', repeats, seconds, 'blocks')
+
+    verifier = SignatureVerifier(1)
+    for tx in block.transactions:  # As Blockchain.add_transaction does
+        assert verifier.verify(tx.prepare_verification())
+    hits = verifier.get_stats()['hits']
+    report('  checked in the memory pool (after)', repeats,
+           timed(lambda: block.validate_transactions(verifier), repeats), 'blocks')
+    print('  cache hits per block: {:.0f}'.format((verifier.get_stats()['hits'] - hits) / repeats))
+
+
+def example_ballot(n):
+    """
+    Creates a transaction that issues n ballots, built with add_output the way a poll issues them.
+    :param n: int - Number of type 1 outputs
+    :return: Transaction
+    """
+    poll_address = '03' + 'ab' * 32
+    voters = ['02' + '{:064x}'.format(i) for i in range(n)]
+    tokens = [dict(example_token(False), voter_address=v, tkid='{:016x}'.format(i)) for i, v in enumerate(voters)]
+    tx = Transaction(1, tokens[0], poll_address, voters[0])
+    tx.inputs = [{'txid': 'e0', 'index': 0, 'value': n, 'recipient': poll_address, 'sig': None, 'type': 0}]
+    tx.create_outputs()
+    for token, voter in zip(tokens[1:], voters[1:]):
+        tx.add_output(token, voter, 1)
+    for output in tx.outputs:
+        output['sig'] = base64.b64encode(bytes(64))
+    return tx
+
+
+def prepare_per_output(tx):
+    """
+    Does the work that Transaction.verify did before it checked the signatures: the totals were computed more than
+    once, and the signing strings of every output were built again for each output.
+    :param tx: Transaction
+    :return: List of (public key, signature, message) tuples, or None if the transaction is invalid
+    """
+    if tx.type == 0 and (tx.value > tx.get_output_total() or tx.get_output_total(True) != tx.get_input_total()):
+        return None
+    elif tx.type == 1:
+        for o in tx.outputs:
+            if o['type'] == 1 and o['value']['voter_address'] != o['recipient']:
+                return None
+    return [(tx.from_address, o['sig'], tx.get_outputs()[o['index']].encode()) for o in tx.outputs]
+
+
+def benchmark_transaction_checks(sizes=(1, 100, 1000)):
+    """
+    Compares the work that Transaction.verify does apart from checking signatures, before and after it was done in one
+    pass over the outputs. The signatures themselves are checked by a SignatureVerifier.
+    :param sizes: Tuple of ints - Numbers of outputs in the transaction
+    :return: None
+    """
+    for n in sizes:
+        print('Checking a ballot issuing transaction (' + str(n) + ' outputs)')
+        tx = example_ballot(n)
+        assert len(tx.outputs) == n
+        assert prepare_per_output(tx) == tx.prepare_verification()
+        repeats = max(1, 20000 // n ** 2)  # The work done before grows with the square of the number of outputs
+        report('  signing strings per output (before)', repeats * n, timed(lambda: prepare_per_output(tx), repeats),
+               'outputs')
+        repeats = max(2, 20000 // n)
+        report('  prepare_verification (after)', repeats * n, timed(tx.prepare_verification, repeats), 'outputs')
+
+
+BENCHMARKS = {'codec': benchmark_value_decoding, 'persistence': benchmark_block_persistence,
+              'queries': benchmark_database_queries, 'loading': benchmark_block_loading,
+              'serving': benchmark_block_serving, 'signatures': benchmark_signature_verification,
+              'sigcache': benchmark_signature_cache, 'transactions': benchmark_transaction_checks}
+
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or BENCHMARKS:
+        BENCHMARKS[name]()
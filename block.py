@@ -4,26 +4,99 @@ Block object store information about a number of transactions.
 The BLock class is used for storing a normal block.
 
 The Mining Block class inherits from the Block and Thread Classes, and it is used to carry out the mining algorithm.
+The nonce search itself is carried out by a MiningEngine, which spreads the work over a pool of processes.
 """
 
-from time import time_ns
+from time import time_ns, monotonic
 from hashlib import sha256
+from mining import MiningEngine, nonce_bytes
 import threading
 
+"""
+Versions of the block hash format:
+    1 - sha256 of timestamp + previous hash + nonce + transaction data. Only used for the genesis block and blocks
+        stored by older versions of the project.
+    2 - sha256 of version + timestamp + previous hash + transaction data + nonce. The nonce comes last, so the hash of
+        everything before it only has to be computed once whilst mining.
+    3 - sha256 of a fixed size header: version + previous hash + Merkle root + timestamp + difficulty + nonce. The
+        header commits to the transactions through the Merkle root, so re-hashing a block doesn't touch them.
+    4 - Same header as version 3, but the difficulty is the expected number of hashes needed to mine the block rather
+        than a number of leading zeros. This lets the difficulty be adjusted in small steps.
+"""
+BLOCK_VERSION = 4
+MAX_TARGET = 2 ** 256 - 1  # Largest possible value of a hash
+SHORT_TXID_LENGTH = 12  # Hex characters of a TXID that are sent in a compact block
+
+
+def get_target(difficulty, version):
+    """
+    Gets the largest value that a block's hash can have, when read as an integer.
+    :param difficulty: int
+    :param version: int - Blocks before version 4 store their difficulty as a number of leading zero hex digits
+    :return: int
+    """
+    if version < 4:
+        return 16 ** (64 - difficulty) - 1
+    return MAX_TARGET // difficulty
+
+
+def get_work(difficulty, version):
+    """
+    Gets the expected number of hashes needed to mine a block.
+    :param difficulty: int
+    :param version: int
+    :return: int
+    """
+    if version < 4:
+        return 16 ** difficulty
+    return difficulty
+
+
+def short_txid(txid):
+    """
+    Gets the short form of a TXID that is sent in a compact block instead of the whole transaction.
+    :param txid: string
+    :return: string
+    """
+    return txid[:SHORT_TXID_LENGTH]
+
+
+def merkle_root(hashes):
+    """
+    Computes the root of a Merkle tree from the hashes of its leaves.
+    When a level has an odd number of hashes, the last one is paired with itself, so a list of hashes that ends with
+    a repeated pair has the same root as the list without the repeat. Blocks with repeated transactions are rejected.
+    :param hashes: List of strings
+    :return: string
+    """
+    if len(hashes) == 0:
+        return '0' * 64
+
+    level = [bytes.fromhex(h) for h in hashes]
+    while len(level) > 1:
+        if len(level) % 2 != 0:
+            level.append(level[-1])
+        level = [sha256(level[i] + level[i + 1]).digest() for i in range(0, len(level), 2)]
+    return level[0].hex()
+
+
 
 class Block:
-    def __init__(self, ph, txs, difficulty, height, genesis=False, callback=None):
+    def __init__(self, ph, txs, difficulty, height, genesis=False, callback=None, version=BLOCK_VERSION):
         self.callback = callback
         if not genesis:
             self.timestamp = time_ns()  # Nano Seconds since epoch
+            self.version = version  # Format used to compute the hash of the block
         else:
             self.timestamp = 0  # By definition, genesis block has a timestamp of 0
+            self.version = 1  # The genesis block keeps the original format, so its hash never changes
 
         self.transactions = txs  # List of transaction objects
         self.order_transactions()
         self.previous_hash = ph  # 64 character string
         self.difficulty = difficulty
         self.nonce = 0  # nonce starts at 0 by default and is used for mining
+        self.merkle_root = self.generate_merkle_root()  # Commits the header to the transactions
         self.hash = self.generate_hash()
         self.genesis = genesis  # Boolean value
         self.height = height  # Points to where the block is in the chain so it can be found easily
@@ -33,8 +106,54 @@ class Block:
         Method computes the hash of the block using the sha256 algorithm.
         :return: string
         """
-        d = str(self.timestamp) + str(self.previous_hash) + str(self.nonce) + self.get_transaction_data()
-        return sha256(d.encode()).hexdigest()
+        if self.version == 1:
+            d = str(self.timestamp) + str(self.previous_hash) + str(self.nonce) + self.get_transaction_data()
+            return sha256(d.encode()).hexdigest()
+
+        return sha256(self.get_header_prefix() + nonce_bytes(self.nonce)).hexdigest()
+
+    def get_header_prefix(self):
+        """
+        Gets the data that is hashed before the nonce.
+        It doesn't change whilst the block is being mined, so miners only hash it once.
+        :return: bytes
+        """
+        if self.version == 2:
+            d = str(self.timestamp) + str(self.previous_hash) + self.get_transaction_data()
+            return self.version.to_bytes(4, 'big') + d.encode()
+
+        return self.version.to_bytes(4, 'big') + bytes.fromhex(self.previous_hash) + bytes.fromhex(self.merkle_root) \
+            + self.timestamp.to_bytes(8, 'big') + self.difficulty.to_bytes(8, 'big')
+
+    def get_target(self):
+        """
+        Gets the largest value that the block's hash can have.
+        :return: int
+        """
+        return get_target(self.difficulty, self.version)
+
+    def get_work(self):
+        """
+        Gets the expected number of hashes needed to mine the block.
+        :return: int
+        """
+        return get_work(self.difficulty, self.version)
+
+    def meets_target(self):
+        """
+        Checks that the block's hash, read as an integer, is no larger than the target.
+        :return: Bool
+        """
+        return int(self.hash, 16) <= self.get_target()
+
+    def generate_merkle_root(self):
+        """
+        Computes the Merkle root of the block's transactions.
+        Has to be called again if the transactions are changed.
+        :return: string
+        """
+        self.order_transactions()
+        return merkle_root([tx.get_leaf_hash() for tx in self.transactions])
 
     def order_transactions(self):
         """
@@ -46,35 +165,42 @@ class Block:
     def get_transaction_data(self):
         """
         Converts the transaction objects into a string to be passed into the hashing algorithm.
-        Inputs and Outputs are dictionaries, and just converting the dictionary to a string is bad because the keys are
-        in a random order. This method ensures that the correct string is produced every time.
+        Only used by blocks of version 1 and 2, later versions hash the Merkle root instead.
         :return: string
         """
-        data = ''
         self.order_transactions()
-        for tx in self.transactions:
-            tx.order_inputs_and_outputs()
-            data += tx.get_core_data()
-            for i in tx.inputs:
-                data += str(i['txid']) + str(i['value']) + str(i['index']) + str(i['type']) + str(i['recipient']) + str(
-                    i['sig'])
-
-            for o in tx.outputs:
-                data += str(o['txid']) + str(o['value']) + str(o['index']) + str(o['type']) + str(o['recipient']) + str(
-                    o['sig'])
-
-        return data
+        return ''.join([tx.get_block_data() for tx in self.transactions])
 
-    def validate_transactions(self):
+    def validate_transactions(self, verifier=None):
         """
         Looks for an invalid transaction in the block.
+        With a verifier, the transactions are checked first and then every signature in the block is checked at once.
+        :param verifier: SignatureVerifier
         :return: Bool
         """
+        # A block with a transaction repeated at the end has the same Merkle root as the block without it, as the last
+        # hash of an odd level is paired with itself, so blocks that contain a TXID twice are rejected
+        txids = set()
         for tx in self.transactions:
-            if not tx.verify():
+            if tx.txid in txids:
+                tx.debug_print('Block: Transaction ' + str(tx.txid) + ' is in the block twice')
                 return False
-        else:
-            return True
+            txids.add(tx.txid)
+
+        if verifier is None:
+            for tx in self.transactions:
+                if not tx.verify():
+                    return False
+            else:
+                return True
+
+        signatures = []
+        for tx in self.transactions:
+            tx_signatures = tx.prepare_verification()
+            if tx_signatures is None:
+                return False
+            signatures += tx_signatures
+        return verifier.verify(signatures)
 
     def get_dictionary_form(self):
         """
@@ -85,7 +211,8 @@ class Block:
         for tx in self.transactions:
             t.append(tx.get_dictionary_form())
         d = {'timestamp': self.timestamp, 'hash': self.hash, 'previous_hash': self.previous_hash, 'nonce': self.nonce,
-             'difficulty': self.difficulty, 'height': self.height, 'transactions': t}
+             'difficulty': self.difficulty, 'height': self.height, 'version': self.version,
+             'merkle_root': self.merkle_root, 'transactions': t}
         return d
 
     def get_sending_form(self):
@@ -100,7 +227,31 @@ class Block:
             t.append(tx.get_sending_form())
         d = {'timestamp': self.timestamp, 'hash': self.hash, 'previous_hash': self.previous_hash,
              'nonce': self.nonce,
-             'difficulty': self.difficulty, 'height': self.height, 'transactions': t, 'data': self.get_transaction_data()}
+             'difficulty': self.difficulty, 'height': self.height, 'version': self.version,
+             'merkle_root': self.merkle_root, 'transactions': t}
+        return d
+
+
+    def get_compact_transactions(self):
+        """
+        Gets the transactions that are sent as short TXIDs in a compact block. The coinbase transaction isn't one of
+        them, as it can't be in anyone else's memory pool.
+        :return: List of Transactions
+        """
+        return [tx for tx in self.transactions if tx.from_address != 'blockchain']
+
+    def get_compact_form(self):
+        """
+        Converts block into a dictionary that can be sent to devices that are likely to have its transactions already.
+        The transactions are replaced by their short TXIDs, apart from the coinbase transaction.
+        :return: dict
+        """
+        d = {'timestamp': self.timestamp, 'hash': self.hash, 'previous_hash': self.previous_hash,
+             'nonce': self.nonce,
+             'difficulty': self.difficulty, 'height': self.height, 'version': self.version,
+             'merkle_root': self.merkle_root,
+             'short_ids': [short_txid(tx.txid) for tx in self.get_compact_transactions()],
+             'prefilled': [tx.get_sending_form() for tx in self.transactions if tx.from_address == 'blockchain']}
         return d
 
 
@@ -109,32 +260,93 @@ class MiningBlock(Block, threading.Thread):
     Inherits from Block because it is a form of a block.
     Inherits from Thread because mining needs to be done on a separate thread to the rest of the program.
     """
-    def __init__(self, ph, txs, difficulty, height, genesis=False, callback=None):
+    def __init__(self, ph, txs, difficulty, height, genesis=False, callback=None, engine=None):
         super(MiningBlock, self).__init__(ph, txs, difficulty, height, genesis=genesis, callback=callback)
         threading.Thread.__init__(self)
         self.terminate_flag = threading.Event()
+        self.engine = engine  # MiningEngine shared by every block that the device mines
 
-    def mining_algorithm(self, tx_data):
+        self.coinbase = [tx for tx in txs if tx.from_address == 'blockchain']  # Kept when the template is refreshed
+        self.template_time = monotonic()  # When the block's transactions were last chosen
+        self.template_pool_size = self.get_memory_pool_size()  # Size of the memory pool when they were chosen
+
+    def get_memory_pool_size(self):
+        """
+        Gets the number of transactions waiting in the memory pool of the blockchain that is mining this block.
+        :return: int
         """
-        Calculates hash as part of the mining algorithm.
-        Different to generate_hash() because it doesn't call get_transaction_data() each time.
+        if self.callback is None:
+            return 0
+        return len(self.callback.memory_pool)
 
-        :param tx_data: string
-        :return: string
+    def template_is_stale(self):
+        """
+        Checks whether enough new transactions have arrived, or enough time has passed, for the block's transactions
+        to be chosen again.
+        :return: Bool
         """
-        d = str(self.timestamp) + str(self.previous_hash) + str(self.nonce) + tx_data
-        return sha256(d.encode()).hexdigest()
+        if self.callback is None:
+            return False
+
+        grown = self.get_memory_pool_size() - self.template_pool_size
+        if grown >= self.callback.template_threshold:
+            return True
+        return grown > 0 and monotonic() - self.template_time >= self.callback.template_interval
+
+    def refresh_template(self):
+        """
+        Swaps the block's transactions for the ones now at the front of the memory pool.
+        The coinbase transaction is kept, and the Merkle root and timestamp are updated. If the same transactions would
+        be chosen, such as when the block is already full, the block is left alone so the nonce search isn't restarted.
+        :return: Bool - True if the transactions changed
+        """
+        transactions = self.callback.get_template_transactions()
+        self.template_time = monotonic()
+        self.template_pool_size = self.get_memory_pool_size()
+        if set(tx.txid for tx in transactions) == set(tx.txid for tx in self.transactions if tx not in self.coinbase):
+            return False
+
+        self.transactions = transactions + self.coinbase
+        self.order_transactions()
+        self.timestamp = time_ns()
+        self.merkle_root = self.generate_merkle_root()
+        self.callback.debug_print('Mining Block: Refreshed template with ' + str(len(self.transactions))
+                                  + ' transactions')
+        return True
 
     def mine_block(self):
         """
         Mining algorithm.
+        The nonce space is searched by the worker processes of the MiningEngine. This thread waits for a result, and
+        cancels the job if the terminate flag is set. When votes arrive whilst mining, the block's transactions are
+        refreshed and the workers are given the new header without being restarted.
         :return: None
         """
-        string = self.get_transaction_data()
+        engine = self.engine
+        if engine is None:  # A block mined on its own gets a pool that only lasts as long as the block
+            engine = MiningEngine()
+
         if self.callback is not None:
             self.callback.debug_print('Mining Block: Started Mining')
-        while self.mining_algorithm(string)[0:self.difficulty] != '0' * self.difficulty and not self.terminate_flag.is_set():
-            self.nonce += 1
+        engine.stats.block_started()
+        job = engine.submit(self.get_header_prefix(), self.get_target())
+        while not self.terminate_flag.is_set():
+            nonce = engine.get_result(job, 0.1)
+            if nonce is not None:
+                self.nonce = nonce
+                engine.stats.block_found()
+                if self.callback is not None:
+                    self.callback.debug_print('Mining Block: Found nonce after {} attempts in {:.1f}s'.format(
+                        engine.stats.get_block_nonces(), engine.stats.last_block_time))
+                break
+
+            if self.template_is_stale() and self.refresh_template():
+                job = engine.submit(self.get_header_prefix(), self.get_target())
+        else:
+            engine.cancel(job)
+
+        if self.engine is None:
+            engine.shutdown()
 
         self.hash = self.generate_hash()
 
@@ -0,0 +1,85 @@
+"""
+BlockStore object keeps the sending form of every block in an append-only file.
+
+Blocks are stored as the bytes of their JSON sending form, one after another, so blocks can be sent to other nodes
+without being rebuilt from the database and encoded again. The database records where each block is in the file, in
+the file_offset and file_length columns of the Blocks table. The file is memory-mapped for reading.
+"""
+
+import json
+import mmap
+import os
+import threading
+
+
+def serialize_block(block):
+    """
+    Converts a block into the bytes that are stored in the file and sent to other nodes.
+    :param block: Block
+    :return: bytes
+    """
+    return json.dumps(block.get_sending_form()).encode('utf-8')
+
+
+class BlockStore:
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'a+b')  # Appending never overwrites a block that is already stored
+        self.size = self.file.seek(0, os.SEEK_END)
+        self.map = None  # Memory map of the file, remade when blocks are read beyond its end
+        self.lock = threading.Lock()  # Blocks are written by the mining and network threads
+
+    def append(self, data):
+        """
+        Adds a block to the end of the file. The block is on disk before this returns, so the database never records
+        a block that isn't in the file.
+        :param data: bytes - Serialized block
+        :return: int - Offset of the block in the file
+        """
+        with self.lock:
+            offset = self.size
+            self.file.write(data)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.size += len(data)
+            return offset
+
+    def read(self, offset, length):
+        """
+        Reads a block from the file.
+        :param offset: int
+        :param length: int
+        :return: bytes
+        """
+        with self.lock:
+            if self.map is None or offset + length > len(self.map):
+                if self.map is not None:
+                    self.map.close()
+                self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            return self.map[offset:offset + length]
+
+    def truncate(self, size):
+        """
+        Removes anything after the last block that the database knows about, such as a block that was being written
+        when the program stopped.
+        :param size: int - Number of bytes to keep
+        :return: None
+        """
+        with self.lock:
+            if self.size > size:
+                if self.map is not None:
+                    self.map.close()
+                    self.map = None
+                self.file.truncate(size)
+                self.size = size
+
+    def close(self):
+        """
+        Closes the file.
+        :return: None
+        """
+        with self.lock:
+            if self.map is not None:
+                self.map.close()
+                self.map = None
+            self.file.close()
@@ -2,9 +2,14 @@
 Blockchain object stores, manages and performs calculations on the data that makes up the blockchain.
 """
 
+from time import time_ns
 from block import Block, MiningBlock
 from transaction import Transaction
 from database_manager import BlockchainDatabase
+from mining import MiningEngine
+from verification import SignatureVerifier
+from mempool import MemoryPool
+from utxo_set import UTXOSet
 
 
 class Blockchain:
@@ -13,17 +18,31 @@ class Blockchain:
         self.block_height = self.database.get_block_height()  # Number of blocks in chain
 
         self.chain = self.database.create_recent_chain()  # List that stores blocks
-        self.memory_pool = []  # List that stores unconfirmed transactions
+        self.memory_pool = MemoryPool()  # Stores unconfirmed transactions
+        self.utxos = UTXOSet()  # Unspent outputs of the blockchain, kept in memory
+        self.utxos.load(self.database.get_all_utxos())
         self.mining_reward = 10  # Number of tokens given upon mining block
 
-        self.difficulty = 6  # Determines the amount of work required to mine a block
+        # The difficulty is the expected number of hashes needed to mine a block. It is adjusted every
+        # retarget_interval blocks so that blocks take target_block_time seconds to mine, however many miners there
+        # are. The interval can't be more than 16, as that is how many blocks are kept in memory.
+        self.initial_difficulty = 16 ** 6
+        self.target_block_time = 60
+        self.retarget_interval = 8
+        self.max_future_time = 600  # Seconds ahead of our clock that a block's timestamp can be
 
         self.wallet = wallet  # The wallet object of the user using the device
         self.handler = handler  # Handler object of the device
         self.mining = False  # Keeps track of whether we are mining a bock or not on another thread
         self.mining_thread = None
+        self.template_threshold = 8  # Transactions added to the memory pool that cause the block being mined to refresh
+        self.template_interval = 10  # Seconds after which a block being mined is refreshed if any transactions arrive
+        self.mining_engine = MiningEngine()  # Pool of processes that search for nonces, started on first use
+        self.mining_stats = self.mining_engine.stats  # Hashrate and other statistics about mining
+        self.verifier = SignatureVerifier()  # Pool of processes that check the signatures of blocks, started on first use
 
         self.create_genesis_block()
+        self.difficulty = self.get_next_difficulty()  # Difficulty that the next block must be mined at
 
         if wallet is not None:
             self.update_wallet()
@@ -38,7 +57,7 @@ class Blockchain:
         :return: None
         """
         if self.block_height < 0:
-            genesis = Block("0" * 64, [], self.difficulty, 0, genesis=True)
+            genesis = Block("0" * 64, [], 6, 0, genesis=True)  # Uses the difficulty format of the first version
             genesis.nonce = 1670
             genesis.hash = genesis.generate_hash()
             self.chain.append(genesis)
@@ -59,19 +78,25 @@ class Blockchain:
         :param mining: Bool - States whether the block will be used for mining
         :return: Block or MiningBlock
         """
-        # Select up to 64 transactions from memory pool
-        transactions = self.memory_pool[0:64]
+        transactions = self.get_template_transactions()
         coinbase = Transaction(0, self.mining_reward, 'blockchain', self.wallet.address, self)
         coinbase.get_inputs()
         transactions.append(coinbase)
         self.debug_print('Blockchain: Creating block')
         if mining:
             return MiningBlock(self.get_last_block().hash, transactions, self.difficulty, self.block_height + 1,
-                               callback=self)
+                               callback=self, engine=self.mining_engine)
         else:
             return Block(self.get_last_block().hash, transactions, self.difficulty, self.block_height + 1,
                          callback=self)
 
+    def get_template_transactions(self):
+        """
+        Selects the transactions from the memory pool that go into the next block.
+        :return: List of Transactions
+        """
+        return self.memory_pool.get_oldest(64)  # Select up to 64 transactions from memory pool
+
     def add_block(self, block, mined=False):
         """
         Verifies and adds block to the chain.
@@ -82,21 +107,24 @@ class Blockchain:
         self.debug_print('Blockchain: Adding block')
         ch = [self.get_last_block(), block]
         # This if statement validates the block
-        if block.validate_transactions() and self.is_valid(ch) and block.height == self.block_height + 1 \
-                and '0' * block.difficulty == block.hash[0:block.difficulty] and block.difficulty >= self.difficulty:
-            for transaction in block.transactions:
-                for tx_input in transaction.inputs:
-                    self.update_utxos(tx_input)
+        if block.height == self.block_height + 1 and self.check_timestamp_and_difficulty(block) \
+                and block.meets_target() and self.is_valid(ch) and block.validate_transactions(self.verifier):
+            # This will also add the transactions, inputs, outputs and tokens, and mark the spent outputs, in a single
+            # database transaction. It is done first, so nothing in memory changes if the block can't be stored.
+            self.database.add_block(block)
+            self.utxos.connect_block(block)
 
             if self.mining:
                 self.mining_thread.terminate_flag.set()
+                if not mined:
+                    self.mining_stats.aborted_blocks += 1  # Another node found a block before us
             self.mining = False  # This is fine here, as if we receive a valid block, we would stop mining anyway
             self.chain.append(block)
             self.update_chain()
+            self.difficulty = self.get_next_difficulty()
             self.update_memory_pool(block.transactions)
 
             self.debug_print('Blockchain: Block added')
-            self.database.add_block(block)  # This will also add the transactions, inputs, outputs, utxos to database
             self.block_height += 1
             self.update_wallet()
             if mined:
@@ -111,10 +139,89 @@ class Blockchain:
             self.debug_print('Blockchain: Cannot add invalid block')
             if block.height != self.block_height + 1:
                 self.debug_print("Blockchain: Problem with block's height")
-            elif '0' * block.difficulty != block.hash[0:block.difficulty] or block.difficulty < self.difficulty:
-                self.debug_print("Blockchain: Block doesn't conform to required difficulty")
+            elif not block.meets_target():
+                self.debug_print("Blockchain: Block's hash doesn't meet its difficulty")
             return False
 
+    def get_next_difficulty(self, chain=None):
+        """
+        Works out the difficulty that the next block has to be mined at.
+        Every retarget_interval blocks, the difficulty is scaled by how much faster or slower than target_block_time
+        the last interval's blocks were mined. It can change by at most a factor of 4 at a time.
+        :param chain: List of Blocks - The end of the chain that the next block follows, if it isn't the chain in memory
+        :return: int
+        """
+        if chain is None:
+            chain = self.chain
+        last = chain[-1]
+        if last.height == 0:
+            return self.initial_difficulty
+
+        difficulty = last.get_work()
+        if last.height % self.retarget_interval != 0 or last.height - self.retarget_interval <= 0:
+            return difficulty  # The genesis block has a timestamp of 0, so it can't be used for timing
+
+        first = self.get_block_from_chain(last.height - self.retarget_interval, chain)
+        if first is None:
+            return difficulty
+
+        actual = max(last.timestamp - first.timestamp, 1)  # Nano seconds
+        expected = int(self.retarget_interval * self.target_block_time * 10 ** 9)
+        new = difficulty * expected // actual
+        new = max(min(new, difficulty * 4), difficulty // 4, 1)
+        if new != difficulty:
+            self.debug_print('Blockchain: Difficulty changed from ' + str(difficulty) + ' to ' + str(new))
+        return new
+
+    def check_timestamp_and_difficulty(self, block, chain=None):
+        """
+        Checks that a block's timestamp is after the block before it and not too far in the future, and that it was
+        mined at exactly the difficulty that the chain requires. The timestamps are used for retargeting, so this stops
+        a miner from lowering the difficulty by faking them, or from claiming a higher difficulty than it mined at.
+        :param block: Block
+        :param chain: List of Blocks - The end of the chain that the block follows, if it isn't the chain in memory
+        :return: Bool
+        """
+        if chain is None:
+            chain, required = self.chain, self.difficulty
+        else:
+            required = self.get_next_difficulty(chain)
+        if block.timestamp <= chain[-1].timestamp:
+            self.debug_print('Blockchain: Block ' + str(block.height) + ' is older than the block before it')
+            return False
+        if block.timestamp > time_ns() + self.max_future_time * 10 ** 9:
+            self.debug_print('Blockchain: Block ' + str(block.height) + ' is from the future')
+            return False
+        if block.get_work() != required:
+            self.debug_print("Blockchain: Block " + str(block.height) + " doesn't conform to required difficulty")
+            return False
+        return True
+
+    def get_block_from_chain(self, height, chain=None):
+        """
+        Finds a block with a given height in the part of the chain stored in memory.
+        :param height: int
+        :param chain: List of Blocks - Searched instead of the chain in memory
+        :return: Block or None
+        """
+        if chain is None:
+            chain = self.chain
+        for block in chain:
+            if block.height == height:
+                return block
+        return None
+
+    def get_recent_block(self, h):
+        """
+        Finds a block with a given hash in the part of the chain stored in memory.
+        :param h: string - Hash of the block
+        :return: Block or None
+        """
+        for block in reversed(self.chain):
+            if block.hash == h:
+                return block
+        return None
+
     def mine_block(self):
         """
         Sets up and starts the mining block.
@@ -135,7 +242,7 @@ class Blockchain:
         :param block: MiningBlock
         :return: None
         """
-        b = Block(block.previous_hash, block.transactions, block.difficulty, block.height)
+        b = Block(block.previous_hash, block.transactions, block.difficulty, block.height, version=block.version)
         b.timestamp = block.timestamp
         b.nonce = block.nonce
         b.hash = block.hash
@@ -163,20 +270,18 @@ class Blockchain:
         :param node: Connection that we received the transaction from
         :return:
         """
-        memory_pool_inputs = []
+        if transaction.txid in self.memory_pool:  # Checked first, as they are much cheaper than verifying
+            self.debug_print('Blockchain: Cannot add the same transaction')
+            return False
+        if self.memory_pool.get_conflicts(transaction):
+            self.debug_print('Blockchain: Output used twice, cannot add transaction')
+            return False
+
         if transaction.verify():
-            for tx in self.memory_pool:
-                if tx.txid == transaction.txid:
-                    self.debug_print('Blockchain: Cannot add the same transaction')
-                    return
-                for i in tx.inputs:
-                    memory_pool_inputs.append(i)
-            intersection = [i for i in transaction.inputs if i in memory_pool_inputs]
-            if intersection:
-                self.debug_print('Blockchain: Output used twice, cannot add transaction')
-
-            self.memory_pool.append(transaction)
-            self.sort_memory_pool()
+            if not self.memory_pool.add(transaction):  # Another thread may have added a conflicting transaction
+                self.debug_print('Blockchain: Cannot add conflicting transaction')
+                return False
+
             self.update_wallet()
             self.handler.tx_added(transaction, node)
             self.debug_print('Blockchain: Added Transaction')
@@ -185,13 +290,6 @@ class Blockchain:
             self.debug_print('Blockchain: Cannot add invalid transaction')
             return False
 
-    def sort_memory_pool(self):
-        """
-        Sorts the transactions in the memory pool by their timestamp.
-        :return: None
-        """
-        self.memory_pool.sort(key=lambda x: x.timestamp)
-
     def is_valid(self, chain=None):  # Returns Boolean value
         """
         Verifies that a chain of blocks form a blockchain.
@@ -236,14 +334,6 @@ class Blockchain:
         """
         return str(len(self.database.get_serialized_votes(poll_addr)))
 
-    def update_utxos(self, tx_input):
-        """
-        Calls for the database to update the outputs that have been used as inputs for transactions.
-        :param tx_input: dict
-        :return: None
-        """
-        self.database.update_utxo(tx_input)
-
     def update_chain(self):  # Deletes oldeest items in chain, so it doesn't take up too much memory
         """
         Manages the part of the blockchain that is stored in memory. It deletes oldest items in the chain.
@@ -256,18 +346,12 @@ class Blockchain:
     def update_memory_pool(self, transactions):
         """
         Removes transactions in the memory pool that are now stored in a block on the blockchain.
+        Transactions that spend the same outputs as the block's transactions can never be mined, so they are removed
+        too.
         :param transactions: list of Transactions
         :return: None
         """
-        txids = [tx.txid for tx in transactions]
-        removed = []
-        for item in self.memory_pool:
-            print(item.txid)
-            if item.txid in txids:
-                removed.append(item)
-
-        for tx in removed:
-            self.memory_pool.remove(tx)
+        self.memory_pool.remove_transactions(transactions)
 
     def get_pending_votes(self, addr=None):
         """
@@ -316,14 +400,7 @@ class Blockchain:
         Calls for the database to convert its data back into a chain of Block objects.
         :return: List of Blocks
         """
-        ph = "0" * 64
-        ch = []
-        for n in range(self.block_height + 1):  # Block-height is 0 only when genesis block is added
-            b = self.database.create_block(ph)
-            ch.append(b)
-            ph = b.hash
-
-        return ch
+        return self.database.get_blocks(0, self.block_height)  # Block-height is 0 only when genesis block is added
 
     def get_last_block(self):
         return self.chain[-1]
@@ -338,7 +415,7 @@ class Blockchain:
         """
         if address is None:
             address = self.wallet.address
-        total = self.database.get_tokens(address, ty)
+        total = self.utxos.get_tokens(address, ty)
         for tx in self.memory_pool:
             if tx.from_address == address:
                 if tx.type == 0 and ty == 0:
@@ -377,7 +454,7 @@ class Blockchain:
         if address is None:
             address = self.wallet.address
 
-        total = self.database.get_tokens(address, ty)  # Returns Number of tokens according to the mined blockchain
+        total = self.utxos.get_tokens(address, ty)  # Returns Number of tokens according to the mined blockchain
         for tx in self.memory_pool:
             if tx.from_address == address:
                 if ty == 0 and tx.type == 0:
@@ -399,14 +476,10 @@ class Blockchain:
         :param ty: int
         :return: list of dictionaries
         """
-        utxos = self.database.get_utxos(addr, ty)
         outputs = []
-        mem_pool_inputs = [i for sub in [tx.inputs for tx in self.memory_pool] for i in sub]
-        for u in utxos:
-            o = {'txid': u[0], 'index': u[1], 'value': eval(u[2]), 'recipient': u[3], 'sig': u[4],
-                 'type': u[5]}
-            if o not in mem_pool_inputs:
-                outputs.append(o)
+        for u in self.utxos.get_utxos(addr, ty):
+            if not self.memory_pool.is_spent(u['txid'], u['index']):
+                outputs.append(u)
 
         return outputs
 
@@ -0,0 +1,117 @@
+"""
+Bounded collections for remembering what the network has already seen, and which signatures have been checked.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class BoundedSet:
+    """
+    A set that holds at most capacity items. When it is full, the item that was added or used longest ago is removed.
+    Used for the inventory that each peer is known to have, so we don't announce or send it the same things again.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.items = OrderedDict()
+        self.lock = threading.Lock()  # Added to by the network thread, and by the GUI and mining threads broadcasting
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, item):
+        return item in self.items
+
+    def add(self, item):
+        """
+        Adds an item, or marks it as the most recently used if it is already in the set.
+        :param item: Hashable
+        :return: Bool - False if the item was already in the set
+        """
+        with self.lock:
+            if item in self.items:
+                self.items.move_to_end(item)
+                return False
+            self.items[item] = None
+            if len(self.items) > self.capacity:
+                self.items.popitem(last=False)
+            return True
+
+
+class SeenCache:
+    """
+    Remembers the TXIDs and block hashes that have recently been added, so duplicates that arrive from other peers can
+    be ignored before they are built and verified again. Also remembers signatures that have been found to be valid,
+    see verification.py.
+    Holds at most capacity items, and forgets items that haven't been seen for ttl seconds, or only when it is full if
+    ttl is None. Counts how often it is checked and how often the item was there.
+    """
+    def __init__(self, capacity, ttl):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.items = OrderedDict()  # Item -> Time that it was last added or seen, oldest first
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def add(self, item):
+        """
+        Records that an item has been seen.
+        :param item: Hashable
+        :return: None
+        """
+        with self.lock:
+            self.items[item] = time.monotonic()
+            self.items.move_to_end(item)
+            if len(self.items) > self.capacity:
+                self.items.popitem(last=False)
+
+    def __contains__(self, item):
+        """
+        Checks whether an item has been seen within the last ttl seconds, without counting the check or refreshing the
+        item. Used for announcements, which don't save any work, so the hit rate only counts duplicates that weren't
+        built and verified again.
+        :param item: Hashable
+        :return: Bool
+        """
+        with self.lock:
+            t = self.items.get(item)
+            return t is not None and (self.ttl is None or time.monotonic() - t < self.ttl)
+
+    def check(self, item):
+        """
+        Checks whether an item has been seen within the last ttl seconds.
+        :param item: Hashable
+        :return: Bool
+        """
+        with self.lock:
+            t = time.monotonic()
+            # Items are in the order they were last seen, so the expired ones are at the start
+            while self.ttl is not None and self.items:
+                oldest = next(iter(self.items.values()))
+                if t - oldest < self.ttl:
+                    break
+                self.items.popitem(last=False)
+
+            if item in self.items:
+                self.items[item] = t  # Duplicates keep arriving while an item is still being relayed
+                self.items.move_to_end(item)
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def get_stats(self):
+        """
+        Gets how well the cache is working. Used for displaying information in the UI.
+        :return: dict
+        """
+        with self.lock:
+            checks = self.hits + self.misses
+            return {'size': len(self.items), 'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': self.hits / checks if checks else 0.0}
+
@@ -0,0 +1,69 @@
+"""
+Encodes and decodes the values stored in the database.
+
+Values used to be stored with str() and read back with eval(), which is slow and runs any code that a peer manages to
+put in a block. They are now stored as compact JSON with a version prefix. Bytes, such as the signatures inside tokens,
+are stored as {"$bytes": "..."}. The order of the keys in a dictionary is kept, because transactions are hashed from
+the string forms of their values.
+
+Values written by older versions of the project have no prefix. They are read with ast.literal_eval, which only accepts
+Python literals.
+"""
+
+import ast
+import json
+
+PREFIX = 'j1:'  # Version 1 of the encoding
+
+
+def to_json(value):
+    """
+    Converts the bytes in a value into objects that JSON can store.
+    :param value: Any
+    :return: Any
+    """
+    if isinstance(value, bytes):
+        return {'$bytes': value.decode('ascii')}
+    elif isinstance(value, dict):
+        return {k: to_json(v) for k, v in value.items()}
+    elif isinstance(value, (list, tuple)):
+        return [to_json(v) for v in value]
+    return value
+
+
+def from_json(d):
+    """
+    Object hook that converts stored bytes back into bytes.
+    :param d: dict
+    :return: dict or bytes
+    """
+    if len(d) == 1 and '$bytes' in d:
+        return d['$bytes'].encode('ascii')
+    return d
+
+
+decoder = json.JSONDecoder(object_hook=from_json)  # Made once, as json.loads makes a new decoder for every call
+
+
+def encode_value(value):
+    """
+    Encodes a value for storing in the database.
+    :param value: int, string, list or dict
+    :return: string
+    """
+    return PREFIX + json.dumps(to_json(value), separators=(',', ':'))
+
+
+def decode_value(text):
+    """
+    Decodes a value stored in the database.
+    :param text: string
+    :return: int, string, list or dict
+    """
+    if text.startswith(PREFIX):
+        return decoder.decode(text[len(PREFIX):])
+
+    try:
+        return ast.literal_eval(text)
+    except (ValueError, SyntaxError):
+        return text  # Strings such as 'Mining Reward' were stored without quotes
@@ -1,22 +1,40 @@
-import socket
 import time
 import threading
+from collections import deque
+from cache import BoundedSet
+from protocol import HEADER_SIZE, FrameError, checksum, get_message_kind, pack_frame, unpack_header
 
 
-class Connection(threading.Thread):
+class Connection:
     """
     Connection Object is what is used to represent and communicate with another device.
-    Inherits attributes from a thread, so it can run without disrupting the rest of the project
+    Its socket is non-blocking and is read and written by the event loop of the main node, so a connection doesn't
+    need a thread of its own.
     """
     def __init__(self, main_node, sock, id, host, port, ty):
-        super(Connection, self).__init__()
-
         self.main_node = main_node
         self.type = ty  # 0 - inbound, 1 - outbound
         self.sock = sock
+        self.sock.setblocking(False)
         self.terminate_flag = threading.Event()
-
-        self.buffer = ''
+        self.connected = False  # Set once the other node has sent its ID
+
+        # Frame being received. The header is read first, then a buffer the size of the payload
+        self.buffer = bytearray(HEADER_SIZE)
+        self.view = memoryview(self.buffer)
+        self.filled = 0  # Number of bytes of the buffer that have been received
+        self.header = None  # (command, length, checksum) of the frame being received, None while reading a header
+
+        # Frames waiting for the socket to be writable. The queue is bounded by main_node.queue_limit bytes, so a slow
+        # peer can't use up our memory, and what happens to frames sent while it is full is set by
+        # main_node.queue_policy
+        self.sending = None  # memoryview of the rest of the frame that is part way through being sent
+        self.queue = deque()  # [key, frame] of the frames that haven't been started. key is None or a string
+        self.queued_bytes = 0  # Bytes of the frames in the queue and of the rest of the frame being sent
+        self.dropped = 0  # Frames thrown away because the queue was full
+        self.dropped_kinds = {}  # Type of message -> Number of frames of that type thrown away
+        self.coalesced = 0  # Frames that replaced an older frame with the same key
+        self.lock = threading.Lock()  # Messages are sent from the GUI, mining and network threads
 
         # These variables store key attributes of the node that this connection represents
         self.host = host
@@ -27,8 +45,7 @@ class Connection(threading.Thread):
         self.last_send = ''  # Time since we last sent something to this
         self.last_recv = ''  # Time since we last received something from this node
         self.blockheight = 0  # How many blocks are stored on the node
-
-        self.debug_print("Connection: Started with client (" + self.id + ") '" + self.host + ":" + str(self.port) + "'")
+        self.known_inventory = BoundedSet(20000)  # TXIDs and block hashes that the node is known to have
 
     def debug_print(self, msg):
         """
@@ -39,73 +56,200 @@ class Connection(threading.Thread):
         if self.main_node is not None:
             self.main_node.debug_print(msg)
 
-    def send(self, data):
+    def send(self, data, command='json', key=None):
         """
-        Sends a message to the other device
-        :param data: JSON message
-        :return: None
+        Sends a message to the other device. Never blocks.
+        If nothing is waiting to be sent, as much of the message as the socket will take is sent straight away. The rest
+        is queued for the event loop to send.
+        :param data: JSON message, as a string or as UTF-8 bytes
+        :param command: string - Type of the message
+        :param key: string - Messages with the same key replace each other when the queue is full and the policy is
+        'coalesce'. None if the message can't be replaced
+        :return: Bool - False if the message was dropped
         """
-        try:
-            data += '-TSN'  # So the receiving node knows when the message has ended
-            self.sock.sendall(data.encode('utf-8'))
-            self.last_send = time.time_ns()
-            self.main_node.last_send = time.time_ns()
-            self.main_node.update_last_send()
-        except Exception as e:
-            self.debug_print("Connection: Node stopping because of exception " + str(e))
-            self.terminate_flag.set()
-
-    def stop(self):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        frame = pack_frame(command, data)
+
+        with self.lock:
+            if self.terminate_flag.is_set():
+                return False
+            if self.sending is None and not self.queue:
+                try:
+                    sent = self.sock.send(frame)
+                except BlockingIOError:
+                    sent = 0
+                except OSError as e:
+                    self.debug_print("Connection: Node stopping because of exception " + str(e))
+                    self.stop()
+                    return False
+                if sent < len(frame):
+                    self.sending = memoryview(frame)[sent:]
+                    self.queued_bytes = len(self.sending)
+                    self.main_node.wake(self)
+            elif not self.enqueue(frame, key):
+                return False
+
+        self.last_send = time.time_ns()
+        self.main_node.last_send = time.time_ns()
+        self.main_node.update_last_send()
+        return True
+
+    def enqueue(self, frame, key):
         """
-        Terminates the thread.
-        :return: None
+        Adds a frame to the queue, applying the main node's policy if the queue is full. The lock must be held by the
+        caller.
+        :param frame: bytes
+        :param key: string or None
+        :return: Bool - False if the frame was dropped
         """
-        self.terminate_flag.set()
-
-    def run(self):
+        if self.queued_bytes > 0 and self.queued_bytes + len(frame) > self.main_node.queue_limit:
+            policy = self.main_node.queue_policy
+            if policy == 'coalesce' and key is not None:
+                for item in self.queue:
+                    if item[0] == key:
+                        self.queued_bytes += len(frame) - len(item[1])
+                        item[1] = frame
+                        self.coalesced += 1
+                        return True
+
+            self.dropped += 1
+            kind = get_message_kind(frame)
+            self.dropped_kinds[kind] = self.dropped_kinds.get(kind, 0) + 1
+
+            # Messages without a key, such as blocks, announcements and replies to the sync, can't be replaced by a
+            # later message, so a peer that would miss one is disconnected rather than left waiting for it
+            if policy == 'disconnect' or (policy == 'coalesce' and key is None):
+                self.debug_print('Connection: Send queue of ' + str(self.id) + ' is full, disconnecting')
+                self.queue.clear()
+                self.queued_bytes = 0
+                self.sending = None  # Closes without waiting for the peer to read what is left
+                self.stop()
+            return False
+
+        self.queue.append([key, frame])
+        self.queued_bytes += len(frame)
+        self.main_node.wake(self)
+        return True
+
+    def get_queue_depth(self):
         """
-        Main loop of the thread.
-        Constantly listens for messages from the connection
-        :return: None
+        Gets the number of frames that are waiting to be sent.
+        :return: int
         """
-        self.sock.settimeout(1)
+        return len(self.queue) + (self.sending is not None)
 
-        while not self.terminate_flag.is_set():
-            line = ""
+    def has_outgoing(self):
+        """
+        Checks whether anything is waiting to be sent.
+        :return: Bool
+        """
+        return self.sending is not None or bool(self.queue)
 
+    def flush(self):
+        """
+        Sends as many of the waiting frames as the socket will take. Called by the event loop.
+        :return: Bool - True if every waiting frame has been sent
+        """
+        with self.lock:
             try:
-                line = self.sock.recv(4096)
-                self.last_recv = time.time_ns()
-                if line == b'':  # Happens when connection breaks - used for hard socket closures
-                    self.terminate_flag.set()
-            except socket.timeout:
-                pass
-
-            except Exception as e:
+                while True:
+                    if self.sending is None:
+                        if not self.queue:
+                            return True
+                        self.sending = memoryview(self.queue.popleft()[1])
+                    sent = self.sock.send(self.sending)
+                    self.queued_bytes -= sent
+                    if sent < len(self.sending):
+                        self.sending = self.sending[sent:]
+                        return False
+                    self.sending = None
+            except BlockingIOError:
+                return False
+            except OSError:
+                self.queue.clear()
+                self.queued_bytes = 0
+                self.sending = None
                 self.terminate_flag.set()
-                print(e)
+                return True
 
-            if line != "":
-                try:
-                    self.buffer += str(line.decode('utf-8'))
-
-                except Exception as e:
-                    self.debug_print("Connection: Error decoding line: " + str(e))
-
-                # Get the messages by finding the message ending -TSN
-                index = self.buffer.find("-TSN")
-                while index > 0:
-                    message = self.buffer[0:index]
-                    self.buffer = self.buffer[index + 4::]
+    def receive(self):
+        """
+        Reads the bytes that are waiting on the socket. Called by the event loop when the socket is readable.
+        Only as many bytes as the current header or payload needs are read at a time.
+        :return: Bool - False if the connection was closed or sent an invalid frame
+        """
+        while True:
+            try:
+                r = self.sock.recv_into(self.view[self.filled:])
+            except BlockingIOError:
+                return True
+            except OSError as e:
+                self.debug_print('Connection: ' + str(e))
+                return False
+            if r == 0:  # Happens when connection breaks - used for hard socket closures
+                return False
+
+            self.filled += r
+            self.last_recv = time.time_ns()
+            if self.filled < len(self.buffer):
+                continue
 
-                    self.main_node.node_message(self, message)
+            try:
+                if self.header is None:
+                    self.header = unpack_header(self.buffer)
+                    self.buffer = bytearray(self.header[1])
+                    if self.header[1] > 0:
+                        self.view = memoryview(self.buffer)
+                        self.filled = 0
+                        continue
+
+                header, payload = self.header, self.buffer
+                self.buffer = bytearray(HEADER_SIZE)
+                self.view = memoryview(self.buffer)
+                self.filled = 0
+                self.header = None
+                self.frame_received(header[0], payload, header[2])
+
+            except FrameError as e:  # The stream can't be trusted after a bad frame
+                self.debug_print("Connection: Node stopping because of exception " + str(e))
+                return False
+
+            except Exception as e:  # A message that can't be handled mustn't stop the event loop for every peer
+                self.debug_print('Connection: Error handling message from ' + str(self.id) + ': ' + repr(e))
+
+    def frame_received(self, command, payload, check):
+        """
+        Passes a complete frame on to the main node.
+        :param command: string
+        :param payload: bytearray
+        :param check: bytes - Checksum from the frame's header
+        :return: None
+        """
+        if checksum(payload) != check:
+            raise FrameError('Checksum of ' + command + ' message does not match')
 
-                    index = self.buffer.find("-TSN")
+        if command == 'id':  # The first frame from each side of a connection is its ID
+            if not self.connected:
+                self.id = payload.decode('ascii')
+                self.connected = True
+                self.main_node.node_connected(self)
+            return
 
-            time.sleep(0.01)
+        try:
+            message = payload.decode('utf-8')
+        except UnicodeDecodeError as e:
+            self.debug_print("Connection: Error decoding message: " + str(e))
+            return
+        self.main_node.node_message(self, message)
 
-        self.main_node.debug_print('Connection: Connection Stopped with host {}'.format(self.host))
-        self.main_node.node_disconnected(self)
+    def stop(self):
+        """
+        Closes the connection once the messages waiting to be sent have been sent.
+        :return: None
+        """
+        self.terminate_flag.set()
+        self.main_node.wake(self)
 
     def __str__(self):
         return """Node ID: {}\nAddress: {}""".format(self.id, self.host)
@@ -4,8 +4,11 @@ Object that manages the database that stores the blockchain.
 
 import sqlite3
 from transaction import Transaction
-from block import Block
+from block import Block, get_work
+from codec import encode_value, decode_value
+from block_store import BlockStore, serialize_block
 import os
+import sys
 
 
 class BlockchainDatabase:
@@ -14,8 +17,33 @@ class BlockchainDatabase:
         with sqlite3.connect(p + name + '.db', check_same_thread=False) as self.db:
             self.cursor = self.db.cursor()
 
+        self.set_pragmas()
         self.setup_database()
         self.blockchain = blockchain
+        self.block_store = BlockStore(p + name + '.blk')  # Serialized blocks, for sending to other nodes
+
+        if not self.check_chain_tip():  # The tip is missing in databases made by older versions of the project
+            self.rebuild_chain_tip()
+        self.check_block_store()
+
+    def close(self):
+        """
+        Closes the database and the block file.
+        :return: None
+        """
+        self.block_store.close()
+        self.db.close()
+
+    def set_pragmas(self):
+        """
+        Tunes the connection. A block is written in one transaction, so with WAL journaling only the commit needs to
+        wait for the disk, and reads from the GUI aren't blocked by a block being written.
+        journal_mode is stored in the database file, the other pragmas only last as long as the connection.
+        :return: None
+        """
+        self.cursor.execute('PRAGMA journal_mode = WAL')
+        self.cursor.execute('PRAGMA synchronous = NORMAL')  # Safe with WAL, a crash can only lose the last commits
+        self.cursor.execute('PRAGMA cache_size = -16000')  # 16 MB of pages
 
     def setup_database(self):
         """
@@ -119,93 +147,153 @@ class BlockchainDatabase:
         );
         """)
 
-    def add_block(self, block):
-        """
-        Adds a block to the database.
-        :param block: Block
-        :return: None
+        # Single row describing the last block of the chain. Work is stored as text, as it can be larger than 64 bits
+        self.cursor.execute("""
+        CREATE TABLE IF NOT EXISTS Chain_Tip(
+        id INTEGER PRIMARY KEY CHECK (id = 0),
+        hash CHAR(64),
+        height INTEGER,
+        work TEXT,
+        FOREIGN KEY (hash) REFERENCES Blocks(hash)
+        );
+        """)
+
+        self.migrate_database()
+
+    def migrate_database(self):
         """
-        sql = '''
-        INSERT INTO Blocks VALUES (?,?,?,?,?,?);
-        '''
-        hash = block.hash
-        p_hash = block.previous_hash
-        t = block.timestamp
-        d = block.difficulty
-        n = block.nonce
-        h = block.height
-        self.cursor.execute(sql, [hash, p_hash, t, d, n, h])
-        self.db.commit()
-        for transaction in block.transactions:
-            self.add_transaction(transaction, hash)
-
-        return
-
-    def add_transaction(self, tx, h):
-        """
-        Adds a transaction to the database.
-        :param tx: Transaction
-        :param h: int
+        Brings a database created by an older version of the project up to date.
+        PRAGMA user_version stores how many of the migrations have already been run on the database.
         :return: None
         """
-        sql = '''
-        INSERT INTO Transactions VALUES (?,?,?,?,?,?);
-        '''
-        self.cursor.execute(sql, [tx.txid, h, tx.type, str(tx.value), tx.from_address, tx.timestamp])
-        self.db.commit()
+        migrations = [self.add_block_versions, self.add_merkle_roots, self.encode_values, self.add_indexes,
+                      self.add_block_file_offsets]
 
-        for i in tx.inputs:
-            self.add_input(i, tx.txid)
+        self.cursor.execute('PRAGMA user_version')
+        n = self.cursor.fetchall()[0][0]
+        for migration in migrations[n:]:
+            migration()
+            n += 1
+            self.cursor.execute('PRAGMA user_version = ' + str(n))
+            self.db.commit()
 
-        for o in tx.outputs:
-            self.add_output(o)
-
-        return
+    def add_block_versions(self):
+        """
+        Migration that stores the hash format of each block. Blocks that are already stored use the original format.
+        :return: None
+        """
+        self.cursor.execute('ALTER TABLE Blocks ADD COLUMN version INTEGER DEFAULT 1')
 
-    def add_input(self, i, txid):
+    def add_merkle_roots(self):
         """
-        Adds an input to the database.
-        :param i: dict
-        :param txid: string
-        :return:
+        Migration that stores the Merkle root of each block, so headers can be read without their transactions.
+        Blocks that are already stored are left without one, as their hashes don't depend on it.
+        :return: None
         """
-        sql = '''
-        INSERT INTO Inputs VALUES (?,?,?,?,?,?,?);
-        '''
-        self.cursor.execute(sql, [txid, i['txid'], i['index'], str(i['value']), i['recipient'], i['sig'], i['type']])
-        self.db.commit()
-        return
+        self.cursor.execute('ALTER TABLE Blocks ADD COLUMN merkle_root CHAR(64)')
 
-    def add_output(self, o):
+    def encode_values(self):
         """
-        Adds an output to the database.
-        :param o: dict
+        Migration that re-encodes values stored with str() into the format of the codec module.
         :return: None
         """
-        sql = '''
-        INSERT INTO Outputs VALUES (?,?,?,?,?,?,?);
-        '''
-        self.cursor.execute(sql, [o['txid'], o['index'], str(o['value']), o['recipient'], o['sig'], True, o['type']])
-        self.db.commit()
+        columns = [('Transactions', 'value', 'txid'), ('Inputs', 'value', 'txid, output_txid, ind'),
+                   ('Outputs', 'value', 'txid, ind'), ('Serialised_Tokens', 'options', 'tkid'),
+                   ('Locked_Tokens', 'options', 'tkid')]
+        for table, column, key in columns:
+            self.cursor.execute('SELECT ' + column + ', ' + key + ' FROM ' + table)
+            rows = [[encode_value(decode_value(r[0]))] + list(r[1:]) for r in self.cursor.fetchall()
+                    if r[0] is not None]
+            condition = ' AND '.join([k + ' = ?' for k in key.split(', ')])
+            self.cursor.executemany('UPDATE ' + table + ' SET ' + column + ' = ? WHERE ' + condition, rows)
 
-        if o['type'] == 1:
-            self.add_token(o['value'], o['txid'], o['index'])
-        elif o['type'] == 2:
-            self.update_token(o['value'], o['txid'], o['index'])
+    def add_indexes(self):
+        """
+        Migration that adds the indexes used to look up outputs, votes and blocks, so they aren't found by scanning
+        whole tables. The indexes on Transactions hold every column that their queries read.
+        :return: None
+        """
+        # get_utxos and get_tokens. The rest of each output is read from the table, as copying the value and signature
+        # into the index would double the size of the table
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS Outputs_Recipient ON Outputs (recipient, type, utxo)')
+        # get_serialized_votes and get_confirmed_votes
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS Transactions_From ON Transactions (from_address, type, txid)')
+        # Transactions of a block, joined from Blocks in get_blocks
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS Transactions_Block ON Transactions (block_hash, txid)')
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS Blocks_Height ON Blocks (height)')
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS Blocks_Previous ON Blocks (previous_hash)')
 
-    def update_utxo(self, utxo):
+    def add_block_file_offsets(self):
         """
-        Updates outputs in the database that have now been spent.
-        :param utxo:
+        Migration that stores where each block is in the block file. Blocks that are already stored are added to the
+        file by check_block_store.
         :return: None
         """
-        sql = '''
-        UPDATE Outputs
-        SET utxo = FALSE
-        WHERE txid = ? AND ind = ?'''
+        self.cursor.execute('ALTER TABLE Blocks ADD COLUMN file_offset INTEGER')
+        self.cursor.execute('ALTER TABLE Blocks ADD COLUMN file_length INTEGER')
 
-        self.cursor.execute(sql, [utxo['txid'], utxo['index']])
-        self.db.commit()
+    def add_block(self, block):
+        """
+        Adds a block to the database, along with its transactions, inputs, outputs and tokens, and marks the outputs
+        that it spends.
+        Everything is written in one SQLite transaction, so a block is stored completely or not at all. The block is
+        also added to the block file first, so a block in the database is always in the file, and removed from the
+        file again if the transaction fails.
+        :param block: Block
+        :return: None
+        """
+        transactions = []
+        inputs = []
+        outputs = []
+        tokens = []  # Tokens of type 1
+        locked = []  # Tokens of type 2
+        spent = []
+        for tx in block.transactions:
+            transactions.append([tx.txid, block.hash, tx.type, encode_value(tx.value), tx.from_address, tx.timestamp])
+            for i in tx.inputs:
+                inputs.append([tx.txid, i['txid'], i['index'], encode_value(i['value']), i['recipient'], i['sig'],
+                               i['type']])
+                spent.append([i['txid'], i['index']])
+
+            for o in tx.outputs:
+                outputs.append([o['txid'], o['index'], encode_value(o['value']), o['recipient'], o['sig'], True,
+                                o['type']])
+                if o['type'] == 1 or o['type'] == 2:
+                    tk = o['value']
+                    row = [tk['tkid'], tk['poll_address'], tk['voter_address'], tk['timestamp'], tk['question'],
+                           encode_value(tk['options']), tk['ans'], tk['sig'], o['txid'], o['index']]
+                    if o['type'] == 1:
+                        tokens.append(row + [False])
+                    else:
+                        locked.append(row)
+
+        data = serialize_block(block)
+        offset = self.block_store.append(data)
+        try:
+            with self.db:  # Commits if every statement succeeds, otherwise rolls all of them back
+                self.cursor.execute('''
+                INSERT INTO Blocks (hash, previous_hash, timestamp, difficulty, nonce, height, version, merkle_root,
+                file_offset, file_length)
+                VALUES (?,?,?,?,?,?,?,?,?,?)
+                ''', [block.hash, block.previous_hash, block.timestamp, block.difficulty, block.nonce, block.height,
+                      block.version, block.merkle_root, offset, len(data)])
+                tip = self.get_chain_tip()
+                work = (tip['work'] if tip is not None else 0) + block.get_work()
+                self.cursor.execute('INSERT OR REPLACE INTO Chain_Tip VALUES (0,?,?,?)', [block.hash, block.height,
+                                                                                       str(work)])
+                # Spent outputs are marked before the new outputs are added, as the input of a coinbase transaction has
+                # the same TXID and index as its output
+                self.cursor.executemany('UPDATE Outputs SET utxo = FALSE WHERE txid = ? AND ind = ?', spent)
+                self.cursor.executemany('INSERT INTO Transactions VALUES (?,?,?,?,?,?)', transactions)
+                self.cursor.executemany('INSERT INTO Inputs VALUES (?,?,?,?,?,?,?)', inputs)
+                self.cursor.executemany('INSERT INTO Outputs VALUES (?,?,?,?,?,?,?)', outputs)
+                self.cursor.executemany('INSERT INTO Serialised_Tokens VALUES (?,?,?,?,?,?,?,?,?,?,?)', tokens)
+                self.cursor.executemany('UPDATE Serialised_Tokens SET locked = TRUE WHERE tkid = ?',
+                                        [[row[0]] for row in locked])
+                self.cursor.executemany('INSERT INTO Locked_Tokens VALUES (?,?,?,?,?,?,?,?,?,?)', locked)
+        except Exception:
+            self.block_store.truncate(offset)  # The block wasn't stored, so it is removed from the file again
+            raise
 
     def get_utxos(self, addr, ty):
         sql2 = '''
@@ -218,6 +306,24 @@ class BlockchainDatabase:
 
         return results
 
+    def get_all_utxos(self):
+        """
+        Gets every unspent output in one query. Used to load the UTXO set when the program starts.
+        :return: List of dictionaries
+        """
+        sql = '''
+        SELECT txid, ind, value, recipient, sig, type FROM Outputs
+        WHERE utxo = TRUE
+        '''
+
+        self.cursor.execute(sql)
+        outputs = []
+        for o in self.cursor.fetchall():
+            value = decode_value(o[2])
+            outputs.append({'txid': o[0], 'index': o[1], 'value': value, 'recipient': o[3], 'sig': o[4], 'type': o[5]})
+
+        return outputs
+
     def get_tokens(self, addr, ty):
         """
         Returns the number of tokens of a particular type that haven't been spent, as known by the Blockchain.
@@ -237,196 +343,298 @@ class BlockchainDatabase:
         t = 0
         if ty == 0:
             for value in results:
-                t += int(value[0])
+                t += int(decode_value(value[0]))
         else:
             t = len(results)
 
         return t
 
-    def create_transaction(self, txid):
+    def build_transaction(self, row, inputs, outputs):
         """
-        Creates a Transaction object from releavnt data in the database
-        :param txid: string
+        Creates a Transaction object from its row in the database and the rows of its inputs and outputs.
+        :param row: Tuple - (type, from_address, txid, timestamp)
+        :param inputs: List of Tuples - Rows of the Inputs table
+        :param outputs: List of Tuples - Rows of the Outputs table, in order of their index
         :return: Transaction
         """
-        inputs = []
-        outputs = []
-
-        sql = '''SELECT type, from_address, txid, timestamp FROM Transactions WHERE txid = ?'''
-        self.cursor.execute(sql, [txid])
-        results = self.cursor.fetchall()[0]
-
-        tx = Transaction(results[0], None, results[1], None, blockchain=self.blockchain)
-        tx.txid = results[2]
-        tx.timestamp = results[3]
-
-        sql = '''SELECT * FROM Inputs WHERE txid = ?'''
-        self.cursor.execute(sql, [txid])
-        results = self.cursor.fetchall()
-        for i in results:
-            try:
-                value = eval(i[3])
-            except Exception as e:
-                value = i[3]
+        tx = Transaction(row[0], None, row[1], None, blockchain=self.blockchain)
+        tx.txid = row[2]
+        tx.timestamp = row[3]
 
-            inputs.append({'txid': i[1], 'index': i[2], 'value': value, 'recipient': i[4], 'sig': i[5], 'type': i[6]})
+        for i in inputs:
+            value = decode_value(i[3])
+            tx.inputs.append({'txid': i[1], 'index': i[2], 'value': value, 'recipient': i[4], 'sig': i[5],
+                              'type': i[6]})
 
-        sql = '''SELECT * FROM Outputs WHERE txid = ? ORDER BY ind '''
-        self.cursor.execute(sql, [txid])
-        results = self.cursor.fetchall()
         addresses = []
-        for o in results:
-            try:
-                value = eval(o[2])
-            except Exception as e:
-
-                value = o[2]
-            outputs.append({'txid': o[0], 'index': o[1], 'value': value, 'recipient': o[3], 'sig': o[4], 'type': o[6]})
-
-
+        for o in outputs:
+            value = decode_value(o[2])
+            tx.outputs.append({'txid': o[0], 'index': o[1], 'value': value, 'recipient': o[3], 'sig': o[4],
+                               'type': o[6]})
             if o[3] not in addresses:
                 addresses.append(o[3])
         tx.to_address = addresses
-        tx.value = outputs[0]['value']
-
-        tx.inputs = inputs
-        tx.outputs = outputs
+        tx.value = tx.outputs[0]['value']
         return tx
 
-    def create_block(self, ph):
+    def create_transaction(self, txid):
         """
-        Creates a block from the database.
-        :param ph: string
-        :return: Block
+        Creates a Transaction object from releavnt data in the database
+        :param txid: string
+        :return: Transaction
         """
-        txs = []
+        self.cursor.execute('SELECT type, from_address, txid, timestamp FROM Transactions WHERE txid = ?', [txid])
+        row = self.cursor.fetchall()[0]
+        self.cursor.execute('SELECT * FROM Inputs WHERE txid = ?', [txid])
+        inputs = self.cursor.fetchall()
+        self.cursor.execute('SELECT * FROM Outputs WHERE txid = ? ORDER BY ind', [txid])
+        outputs = self.cursor.fetchall()
+        return self.build_transaction(row, inputs, outputs)
 
+    def get_blocks(self, first, last):
+        """
+        Creates the blocks in a range of heights from the database.
+        Every block, transaction, input and output in the range is read with one query per table, rather than a few
+        queries for each transaction.
+        :param first: int - Height of the first block
+        :param last: int - Height of the last block
+        :return: List of Blocks - In order of height
+        """
         sql = '''
-        SELECT Transactions.txid FROM Transactions
-        INNER JOIN Blocks ON Blocks.hash = Transactions.block_hash
-        WHERE previous_hash = ?
+        SELECT hash, previous_hash, timestamp, difficulty, nonce, height, version FROM Blocks
+        WHERE height BETWEEN ? AND ?
+        ORDER BY height
         '''
+        self.cursor.execute(sql, [first, last])
+        blocks = self.cursor.fetchall()
 
-        self.cursor.execute(sql, [ph])
-        results = self.cursor.fetchall()
-
-        for txid in results:
-            txs.append(self.create_transaction(txid[0]))
+        # Transactions are read in the order they were stored, which is their order in the block
+        sql = '''
+        SELECT Transactions.type, from_address, txid, Transactions.timestamp, block_hash FROM Transactions
+        INNER JOIN Blocks ON Blocks.hash = Transactions.block_hash
+        WHERE height BETWEEN ? AND ?
+        ORDER BY Transactions.rowid
+        '''
+        self.cursor.execute(sql, [first, last])
+        transactions = self.cursor.fetchall()
 
-        sql = '''SELECT difficulty, nonce, hash, timestamp, height FROM Blocks WHERE previous_hash = ?'''
+        inputs = {}  # TXID -> Rows of the transaction's inputs
+        sql = '''
+        SELECT Inputs.* FROM Inputs
+        INNER JOIN Transactions ON Transactions.txid = Inputs.txid
+        INNER JOIN Blocks ON Blocks.hash = Transactions.block_hash
+        WHERE height BETWEEN ? AND ?
+        ORDER BY Inputs.rowid
+        '''
+        self.cursor.execute(sql, [first, last])
+        for i in self.cursor.fetchall():
+            inputs.setdefault(i[0], []).append(i)
 
-        self.cursor.execute(sql, [ph])
-        results = self.cursor.fetchall()[0]
+        outputs = {}  # TXID -> Rows of the transaction's outputs
+        sql = '''
+        SELECT Outputs.* FROM Outputs
+        INNER JOIN Transactions ON Transactions.txid = Outputs.txid
+        INNER JOIN Blocks ON Blocks.hash = Transactions.block_hash
+        WHERE height BETWEEN ? AND ?
+        ORDER BY Outputs.txid, Outputs.ind
+        '''
+        self.cursor.execute(sql, [first, last])
+        for o in self.cursor.fetchall():
+            outputs.setdefault(o[0], []).append(o)
+
+        txs = {}  # Block hash -> Transactions of the block
+        for row in transactions:
+            txs.setdefault(row[4], []).append(self.build_transaction(row, inputs.get(row[2], []),
+                                                                    outputs.get(row[2], [])))
+
+        chain = []
+        for r in blocks:
+            b = Block(r[1], txs.get(r[0], []), r[3], r[5], version=r[6])
+            b.nonce = r[4]
+            b.hash = r[0]
+            b.timestamp = r[2]
+            chain.append(b)
+        return chain
 
-        b = Block(ph, txs, results[3], results[4])
-        b.nonce = results[1]
-        b.hash = results[2]
-        b.timestamp = results[3]
-        return b
+    def create_block(self, ph):
+        """
+        Creates a block from the database.
+        :param ph: string
+        :return: Block
+        """
+        self.cursor.execute('SELECT height FROM Blocks WHERE previous_hash = ?', [ph])
+        h = self.cursor.fetchall()[0][0]
+        return self.get_blocks(h, h)[0]
 
     def create_recent_chain(self):  # Returns chain of 16 previous blocks
         """
         Creates the chain to be stored in memory by the Blockchain object.
         :return: List of Blocks
         """
-        ch = []
-
         height = self.get_block_height()
+        return self.get_blocks(max(height - 15, 0), height)  # Block-height is 0 only when genesis block is added
 
-        if height >= 16:
-            self.cursor.execute('SELECT previous_hash FROM Blocks WHERE height = ?', [height-15])
-            ph = self.cursor.fetchall()[0][0]
-            for n in range(16):  # Block-height is 0 only when genesis block is added
-                b = self.create_block(ph)
-                ch.append(b)
-                ph = b.hash
-        else:
-            ph = "0" * 64
-            for n in range(height+1):  # Block-height is 0 only when genesis block is added
-                b = self.create_block(ph)
-                ch.append(b)
-                ph = b.hash
-
-        return ch
+    def get_block_height(self):
+        """
+        Gets the height of the last block that is stored in the database.
+        :return: int - -1 if the database is empty
+        """
+        tip = self.get_chain_tip()
+        return tip['height'] if tip is not None else -1
 
-    def add_token(self, tk, txid, ind):
+    def check_block_store(self):
         """
-        Adds a token of type 1 to the database.
-        :param tk: dict
-        :param txid: string
-        :param ind: int
+        Makes the block file match the database. Called when the program starts.
+        Anything written after the tip's block, by a block that was never committed to the database, is removed. Blocks
+        that aren't in the file yet, such as those stored by older versions of the project, are added to it.
         :return: None
         """
-        sql = '''
-        INSERT INTO Serialised_Tokens VALUES (?,?,?,?,?,?,?,?,?,?,?)
-        '''
-        self.cursor.execute(sql, [tk['tkid'], tk['poll_address'], tk['voter_address'], tk['timestamp'], tk['question'],
-                                  str(tk['options']), tk['ans'], tk['sig'], txid, ind, False])
-        self.db.commit()
+        tip = self.get_chain_tip()
+        if tip is None:
+            self.block_store.truncate(0)
+            return
+
+        self.cursor.execute('SELECT file_offset + file_length FROM Blocks WHERE hash = ?', [tip['hash']])
+        end = self.cursor.fetchall()[0][0]
+        if end is not None:
+            self.block_store.truncate(end)
+            return
+
+        self.cursor.execute('SELECT MAX(file_offset + file_length) FROM Blocks')
+        self.block_store.truncate(self.cursor.fetchall()[0][0] or 0)
+        self.cursor.execute('SELECT height FROM Blocks WHERE file_offset IS NULL ORDER BY height')
+        heights = [r[0] for r in self.cursor.fetchall()]
+        missing = set(heights)
+        for n in range(0, len(heights), 64):
+            rows = []
+            for b in self.get_blocks(heights[n], heights[min(n + 63, len(heights) - 1)]):
+                if b.height not in missing:
+                    continue
+                data = serialize_block(b)
+                rows.append([self.block_store.append(data), len(data), b.hash])
+            with self.db:
+                self.cursor.executemany('UPDATE Blocks SET file_offset = ?, file_length = ? WHERE hash = ?', rows)
+
+    # get_raw_block, has_block and has_transaction are called by the network thread whilst blocks are being added, so
+    # they use their own cursors rather than self.cursor
+    def get_raw_block(self, h):
+        """
+        Reads the serialized form of a block from the block file.
+        :param h: string - Hash of the block
+        :return: bytes or None - None if the block isn't stored
+        """
+        r = self.db.execute('SELECT file_offset, file_length FROM Blocks WHERE hash = ?', [h]).fetchall()
+        if not r or r[0][0] is None:
+            return None
+        return self.block_store.read(r[0][0], r[0][1])
+
+    def has_block(self, h):
+        """
+        Checks whether a block is stored.
+        :param h: string - Hash of the block
+        :return: Bool
+        """
+        return len(self.db.execute('SELECT 1 FROM Blocks WHERE hash = ?', [h]).fetchall()) > 0
+
+    def has_transaction(self, txid):
+        """
+        Checks whether a transaction is stored in a block.
+        :param txid: string
+        :return: Bool
+        """
+        return len(self.db.execute('SELECT 1 FROM Transactions WHERE txid = ?', [txid]).fetchall()) > 0
 
-    def update_token(self, tk, txid, ind):
+    def get_raw_blocks(self, first, last, max_bytes=None):
         """
-        Updates the state of a token of type 1 in the database and adds the version of the token when it is of type 2.
-        :param tk: dict
-        :param txid: string
-        :param ind: int
-        :return: None
+        Reads the serialized forms of the blocks in a range of heights from the block file.
+        Uses its own cursor, as it is called by the network thread.
+        :param first: int - Height of the first block
+        :param last: int - Height of the last block
+        :param max_bytes: int - Blocks after the ones that add up to this many bytes aren't read. The first block is
+        always read. None to read every block
+        :return: List of bytes - In order of height
         """
         sql = '''
-        UPDATE Serialised_Tokens
-        SET locked = TRUE
-        WHERE tkid = ?
+        SELECT file_offset, file_length FROM Blocks
+        WHERE height BETWEEN ? AND ?
+        ORDER BY height
         '''
-
-        self.cursor.execute(sql, [tk['tkid']])
-        self.db.commit()
-
+        rows = self.db.execute(sql, [first, last]).fetchall()
+        if max_bytes is not None:
+            total = 0
+            for i, r in enumerate(rows):
+                total += r[1]
+                if total > max_bytes and i > 0:
+                    rows = rows[:i]
+                    break
+        return [self.block_store.read(r[0], r[1]) for r in rows]
+
+    def get_headers(self, first, last):
+        """
+        Gets the headers of the blocks in a range of heights, for sending to a node that is syncing.
+        Uses its own cursor, as it is called by the network thread.
+        :param first: int - Height of the first block
+        :param last: int - Height of the last block
+        :return: List of dicts - In order of height
+        """
         sql = '''
-        INSERT INTO Locked_Tokens VALUES (?,?,?,?,?,?,?,?,?,?)
+        SELECT hash, previous_hash, timestamp, difficulty, nonce, height, version, merkle_root FROM Blocks
+        WHERE height BETWEEN ? AND ?
+        ORDER BY height
         '''
-        self.cursor.execute(sql, [tk['tkid'], tk['poll_address'], tk['voter_address'], tk['timestamp'], tk['question'],
-                                  str(tk['options']), tk['ans'], tk['sig'], txid, ind])
-        self.db.commit()
+        return [{'hash': r[0], 'previous_hash': r[1], 'timestamp': r[2], 'difficulty': r[3], 'nonce': r[4],
+                 'height': r[5], 'version': r[6], 'merkle_root': r[7]} for r in self.db.execute(sql, [first, last])]
 
-    def get_block_height(self):
+    def get_chain_tip(self):
         """
-        Gets the number of blocks that are stored in the database.
-        :return: int
+        Gets the hash, height and cumulative work of the last block that is stored in the database.
+        :return: dict or None - None if the database is empty
         """
-        self.cursor.execute('SELECT hash FROM Blocks')
+        self.cursor.execute('SELECT hash, height, work FROM Chain_Tip')
         r = self.cursor.fetchall()
-        return len(r) - 1  # -1 is key because of genesis block
+        if not r:
+            return None
+        return {'hash': r[0][0], 'height': r[0][1], 'work': int(r[0][2])}
 
-    def block_from_height(self,h):
+    def check_chain_tip(self):
         """
-        Creates a Block from the database based on its height.
-        :param h: int
-        :return: Block
+        Checks that the recorded tip is the highest block in the database. Called when the program starts.
+        :return: Bool
         """
-        txs = []
-
-        sql = '''
-                SELECT Transactions.txid FROM Transactions
-                INNER JOIN Blocks ON Blocks.hash = Transactions.block_hash
-                WHERE height = ?
-                '''
-
-        self.cursor.execute(sql, [h])
-        results = self.cursor.fetchall()
+        tip = self.get_chain_tip()
+        self.cursor.execute('SELECT MAX(height) FROM Blocks')
+        top = self.cursor.fetchall()[0][0]
+        if tip is None:
+            return top is None
 
-        for txid in results:
-            txs.append(self.create_transaction(txid[0]))
+        self.cursor.execute('SELECT height FROM Blocks WHERE hash = ?', [tip['hash']])
+        r = self.cursor.fetchall()
+        return len(r) == 1 and r[0][0] == tip['height'] == top
 
-        sql = '''SELECT difficulty, nonce, hash, timestamp, previous_hash FROM Blocks WHERE height = ?'''
+    def rebuild_chain_tip(self):
+        """
+        Works out the tip from every block in the database. Only needed when check_chain_tip fails.
+        :return: None
+        """
+        self.cursor.execute('SELECT hash, height, difficulty, version FROM Blocks ORDER BY height')
+        work = 0
+        tip = None
+        for b in self.cursor.fetchall():
+            work += get_work(b[2], b[3])
+            tip = [b[0], b[1], str(work)]
 
-        self.cursor.execute(sql, [h])
-        results = self.cursor.fetchall()[0]
+        with self.db:
+            self.cursor.execute('DELETE FROM Chain_Tip')
+            if tip is not None:
+                self.cursor.execute('INSERT INTO Chain_Tip VALUES (0,?,?,?)', tip)
 
-        b = Block(results[4], txs, results[0], h)
-        b.nonce = results[1]
-        b.hash = results[2]
-        b.timestamp = results[3]
-        return b
+    def block_from_height(self, h):
+        """
+        Creates a Block from the database based on its height.
+        :param h: int
+        :return: Block
+        """
+        return self.get_blocks(h, h)[0]
 
     def get_serialized_votes(self,addr):
         """
@@ -454,3 +662,9 @@ class BlockchainDatabase:
         self.cursor.execute(sql, [addr])
         r = self.cursor.fetchall()
         return r
+
+
+if __name__ == '__main__':
+    # Brings a database up to date without starting the app: python database_manager.py <folder of blockchain.db>
+    BlockchainDatabase(None, sys.argv[1])
+    print('Database migrated')
@@ -1,4 +1,5 @@
 # Handler Object
+import queue
 import threading
 import time
 import socket
@@ -7,6 +8,8 @@ import json
 from blockchain import Blockchain
 from block import Block
 from transaction import Transaction
+from cache import SeenCache
+from sync import ChainSync, MAX_HEADERS, MAX_REPLY_BYTES, WINDOW
 
 
 class NodeHandler(threading.Thread):
@@ -17,8 +20,14 @@ class NodeHandler(threading.Thread):
     # These attributes are standard for every device, and are required for the p-2-p network
     default_peer = '10.37.0.42'
     port = 54846
-    version = '1.0'
+    # 2.0 sends messages in frames, see protocol.py. 2.1 announces objects with 'inv' messages. 2.2 syncs headers first,
+    # see sync.py. 2.3 relays blocks in compact form
+    version = '2.3'
     services = 0
+    send_queue_limit = 4 * 2 ** 20  # Bytes that can wait to be sent to each peer
+    # Peer status messages replace each other when a peer's queue is full. A peer that would miss any other message is
+    # disconnected
+    send_queue_policy = 'coalesce'
 
     def __init__(self, path, app=None):
         super(NodeHandler, self).__init__()
@@ -44,7 +53,8 @@ class NodeHandler(threading.Thread):
 
         self.max_peers = 5  # The maximum number of peers that a node can have
 
-        self.node = Node(self.IP, NodeHandler.port, self.callback)
+        self.node = Node(self.IP, NodeHandler.port, self.callback, NodeHandler.send_queue_limit,
+                         NodeHandler.send_queue_policy)
         self.GUI.device_id = self.node.id
         self.GUI.blockheight = str(self.blockchain.block_height)
 
@@ -57,6 +67,29 @@ class NodeHandler(threading.Thread):
 
         self.attempts = 0  # Stores how many attempts have been made to get the blockchain from a node.
 
+        # Transactions and blocks are announced by their TXID or hash with 'inv' messages, and peers ask for the ones
+        # they don't have with 'get_data' messages, so every object is only downloaded once.
+        # TXID or block hash -> [kind, time requested, Connection it was requested from, Connections that announced it]
+        self.requested = {}
+        self.request_timeout = 10  # Seconds after which an object that hasn't arrived is asked for from another peer
+
+        # Blocks are relayed to nodes running 2.3 in compact form, with short TXIDs instead of the transactions, as the
+        # transactions are almost always in the receiver's memory pool already.
+        self.partial_blocks = {}  # Block hash -> [compact form, transactions, Connection, missing indexes, retried]
+
+        # TXIDs and block hashes that we have added recently. Copies that other peers send us are ignored before they
+        # are built and verified again.
+        self.seen = SeenCache(50000, 600)
+
+        self.sync = ChainSync(self)  # Downloads the chain from a peer that has more blocks than us
+
+        # Messages and events from the node are handled on a thread of their own, so building and verifying
+        # transactions and blocks and writing them to the database doesn't hold up the event loop that serves every
+        # peer. Replies go back to the event loop through Connection.send, which wakes it.
+        self.events = queue.Queue()
+        self.event_thread = threading.Thread(target=self.process_events, daemon=True)
+        self.event_thread.start()
+
     def debug_print(self, msg):
         """
         Prints messages to the Console of the GUI.
@@ -117,6 +150,24 @@ class NodeHandler(threading.Thread):
         except Exception as e:
             raise e
 
+    def create_raw_message(self, key, raw):
+        """
+        Creates a message from data that is already JSON, without decoding it and encoding it again.
+        :param key: string
+        :param raw: bytes - JSON
+        :return: bytes
+        """
+        end = self.create_message({}).encode('utf-8')  # '{"time": ..., "snid": ...}'
+        return b'{"' + key.encode('utf-8') + b'": ' + raw + b', ' + end[1:]
+
+    def create_blocks_message(self, blocks):
+        """
+        Creates a 'blocks' message from serialized blocks.
+        :param blocks: List of bytes - Blocks as stored in the block file
+        :return: bytes
+        """
+        return self.create_raw_message('blocks', b'[' + b', '.join(blocks) + b']')
+
     def send_peers(self, n=None):
         """
         Sends a list of our peers to a node
@@ -128,9 +179,9 @@ class NodeHandler(threading.Thread):
                 self.debug_print('Handler: exceeded max peers')
                 self.node.send_to_node(n, self.create_message({'msg': 'disconnect', 'peers': self.peers}))
             else:
-                self.node.send_to_node(n, self.create_message({'peers': self.peers}))
+                self.node.send_to_node(n, self.create_message({'peers': self.peers}), 'peers')
         else:
-            self.node.send_to_nodes(self.create_message({'peers': self.peers}))
+            self.node.send_to_nodes(self.create_message({'peers': self.peers}), key='peers')
 
     def handshake(self, n):
         """
@@ -151,17 +202,268 @@ class NodeHandler(threading.Thread):
         d = {'get_blocks': [self.blockchain.block_height, self.blockchain.block_height+8]}
         self.node.send_to_node(n, self.create_message(d))
 
+    def has_version(self, n, version):
+        """
+        Checks whether a node's version of the code is at least a version.
+        :param n: Connection
+        :param version: List of ints - e.g. [2, 2]
+        :return: Bool
+        """
+        try:
+            return [int(i) for i in str(n.version).split('.')] >= version
+        except ValueError:
+            return False
+
+    def can_sync_headers(self, n):
+        """
+        Checks whether a node's version of the code can send headers and bodies separately.
+        :param n: Connection
+        :return: Bool
+        """
+        return self.has_version(n, [2, 2])
+
+    def send_sync_request(self, n, d):
+        """
+        Sends a get_headers or get_bodies request for the sync.
+        :param n: Connection
+        :param d: dict
+        :return: None
+        """
+        self.node.send_to_node(n, self.create_message(d))
+
+    def sync_finished(self):
+        """
+        Called when the sync has finished.
+        :return: None
+        """
+        self.GUI.update_blockchain()
+        self.broadcast_blockheight()
+        if not self.sync.restart():  # Our peers may have mined more blocks whilst we were syncing
+            for n in self.node.inbound_nodes + self.node.outbound_nodes:
+                if n.blockheight == self.blockchain.block_height:
+                    self.request_memory_pool(n)
+                    break
+
+    def announce(self, kind, ids, ex=None):
+        """
+        Tells our peers about transactions or blocks, so they can request the ones that they don't have.
+        Peers that are known to have an object already aren't told about it.
+        :param kind: string - 'tx' or 'block'
+        :param ids: List of strings - TXIDs or block hashes
+        :param ex: Node - The node that we don't want to announce to
+        :return: None
+        """
+        for n in self.node.inbound_nodes + self.node.outbound_nodes:
+            if n is ex:
+                continue
+            new = [i for i in ids if n.known_inventory.add(i)]
+            if new:
+                self.node.send_to_node(n, self.create_message({'inv': {kind: new}}))
+
+    def has_inventory(self, kind, i):
+        """
+        Checks whether we already have a transaction or block.
+        :param kind: string - 'tx' or 'block'
+        :param i: string - TXID or block hash
+        :return: Bool
+        """
+        if i in self.seen:
+            return True
+        if kind == 'tx':
+            return i in self.blockchain.memory_pool or self.blockchain.database.has_transaction(i)
+        return self.blockchain.database.has_block(i)
+
+    def request_inventory(self, n, inv):
+        """
+        Asks a peer for the announced transactions and blocks that we don't have and haven't already asked for.
+        :param n: Connection
+        :param inv: dict - {'tx': [TXIDs], 'block': [block hashes]}
+        :return: None
+        """
+        t = time.monotonic()
+        wanted = {}
+        for kind in ['tx', 'block']:
+            for i in inv.get(kind, []):
+                n.known_inventory.add(i)
+                if i in self.requested:  # Asked for already, the peer is another one it can be asked from
+                    self.requested[i][3].add(n)
+                elif not self.has_inventory(kind, i):
+                    self.requested[i] = [kind, t, n, {n}]
+                    wanted.setdefault(kind, []).append(i)
+
+        if wanted:
+            self.node.send_to_node(n, self.create_message({'get_data': wanted}))
+
+    def check_requests(self):
+        """
+        Asks another peer that announced an object for it when the peer it was requested from hasn't sent it in time.
+        Objects are forgotten once every peer that announced them has been asked, or has disconnected.
+        :return: None
+        """
+        t = time.monotonic()
+        connected = set(self.node.inbound_nodes + self.node.outbound_nodes)
+        wanted = {}  # Connection -> {'tx': [TXIDs], 'block': [block hashes]}
+        for i, r in list(self.requested.items()):
+            kind, requested, n, announcers = r
+            if t - requested < self.request_timeout:
+                continue
+            announcers.discard(n)
+            announcers &= connected
+            if not announcers or self.has_inventory(kind, i):
+                del self.requested[i]
+                continue
+            n = next(iter(announcers))
+            r[1], r[2] = t, n
+            wanted.setdefault(n, {}).setdefault(kind, []).append(i)
+
+        for n, w in wanted.items():
+            self.node.send_to_node(n, self.create_message({'get_data': w}))
+
+    def send_inventory(self, n, inv):
+        """
+        Sends the transactions and blocks that a peer has asked for.
+        :param n: Connection
+        :param inv: dict - {'tx': [TXIDs], 'block': [block hashes]}
+        :return: None
+        """
+        for txid in inv.get('tx', []):
+            tx = self.blockchain.memory_pool.get(txid)
+            if tx is not None:
+                n.known_inventory.add(txid)
+                self.node.send_to_node(n, self.create_message({'new_tx': tx.get_sending_form()}))
+
+        for h in inv.get('block', []):
+            block = self.blockchain.get_recent_block(h) if self.has_version(n, [2, 3]) else None
+            if block is not None:
+                n.known_inventory.add(h)
+                self.node.send_to_node(n, self.create_message({'cmpct_block': block.get_compact_form()}))
+                continue
+
+            raw = self.blockchain.database.get_raw_block(h)
+            if raw is not None:
+                n.known_inventory.add(h)
+                self.node.send_to_node(n, self.create_raw_message('new_block', raw))
+
+    def receive_block(self, n, b):
+        """
+        Adds a block that a peer has sent us, and announces it to our other peers.
+        :param n: Connection
+        :param b: dict
+        :return: Bool - False if the block follows our last block, but couldn't be added
+        """
+        if self.create_block(b):
+            self.broadcast_block(n)
+        elif b['height'] > self.blockchain.block_height + 1:
+            self.catch_up(n, b['height'])
+        elif b['height'] == self.blockchain.block_height + 1:
+            return False
+        return True
+
+    def catch_up(self, n, height):
+        """
+        Called when a peer sends us a block that doesn't follow our last block, because we have missed the blocks before
+        it. Downloads the blocks that we have missed.
+        :param n: Connection
+        :param height: int - Height of the block
+        :return: None
+        """
+        n.blockheight = max(n.blockheight, height)
+        if not self.can_sync_headers(n):
+            self.get_blocks(n)
+        else:
+            self.sync.start(n, n.blockheight)
+
+    def rebuild_block(self, n, b):
+        """
+        Rebuilds a block sent in compact form from the transactions in our memory pool, and asks the peer for the
+        transactions that we don't have.
+        :param n: Connection
+        :param b: dict - Compact form of the block
+        :return: None
+        """
+        if b['height'] > self.blockchain.block_height + 1:
+            self.catch_up(n, b['height'])
+            return
+        if b['height'] <= self.blockchain.block_height:
+            return
+
+        transactions = []
+        missing = []
+        for i, short_id in enumerate(b['short_ids']):
+            tx = self.blockchain.memory_pool.get_by_short_id(short_id)
+            if tx is None:
+                missing.append(i)
+                transactions.append(None)
+            else:
+                transactions.append(tx.get_sending_form())
+
+        self.partial_blocks[b['hash']] = [b, transactions, n, missing, False]
+        if len(self.partial_blocks) > 16:  # Forgets blocks whose transactions never arrived
+            del self.partial_blocks[next(iter(self.partial_blocks))]
+
+        if missing:
+            self.debug_print('Handler: Asking for ' + str(len(missing)) + ' transactions of a compact block')
+            self.node.send_to_node(n, self.create_message({'get_block_txs': {'hash': b['hash'], 'indexes': missing}}))
+        else:
+            self.complete_block(b['hash'])
+
+    def complete_block(self, h):
+        """
+        Adds a block sent in compact form once all of its transactions have been found.
+        If it can't be added, a short TXID may have matched the wrong transaction in our memory pool, so all of its
+        transactions are asked for once.
+        :param h: string - Hash of the block
+        :return: None
+        """
+        b, transactions, n, missing, retried = self.partial_blocks.pop(h)
+        d = {k: v for k, v in b.items() if k not in ['short_ids', 'prefilled']}
+        d['transactions'] = b['prefilled'] + transactions
+        if not self.receive_block(n, d) and not retried:
+            missing = list(range(len(transactions)))
+            self.partial_blocks[h] = [b, [None] * len(transactions), n, missing, True]
+            self.node.send_to_node(n, self.create_message({'get_block_txs': {'hash': h, 'indexes': missing}}))
+
+    def send_block_transactions(self, n, request):
+        """
+        Sends the transactions of a compact block that a peer didn't have.
+        :param n: Connection
+        :param request: dict - {'hash': block hash, 'indexes': [indexes of the block's short TXIDs]}
+        :return: None
+        """
+        block = self.blockchain.get_recent_block(request['hash'])
+        if block is None:
+            return
+        transactions = block.get_compact_transactions()
+        d = {'hash': request['hash'],
+             'transactions': [transactions[i].get_sending_form() for i in request['indexes'] if i < len(transactions)]}
+        self.node.send_to_node(n, self.create_message({'block_txs': d}))
+
+    def block_transactions_received(self, n, d):
+        """
+        Fills in the transactions of a compact block that we asked a peer for.
+        :param n: Connection
+        :param d: dict - {'hash': block hash, 'transactions': [transactions in the order that they were asked for]}
+        :return: None
+        """
+        partial = self.partial_blocks.get(d['hash'])
+        if partial is None or partial[2] is not n:
+            return
+
+        for i, tx in zip(partial[3], d['transactions']):
+            partial[1][i] = tx
+        if None in partial[1]:
+            self.debug_print('Handler: Transactions of a compact block are missing')
+            del self.partial_blocks[d['hash']]
+        else:
+            self.complete_block(d['hash'])
+
     def broadcast_block(self, ex=None):
         """
-        Sends a block to our peers
+        Announces our last block to our peers
         :param ex: Node - The node that we don't want to send the block back to
         :return: None
         """
-        d = {'new_block': self.blockchain.get_last_block().get_sending_form()}
-        if ex is not None:
-            self.node.send_to_nodes(self.create_message(d), [ex])
-        else:
-            self.node.send_to_nodes(self.create_message(d))
+        self.announce('block', [self.blockchain.get_last_block().hash], ex)
 
     def broadcast_blockheight(self):
         """
@@ -169,20 +471,16 @@ class NodeHandler(threading.Thread):
         :return: Node
         """
         d = {'block_height': self.blockchain.block_height}
-        self.node.send_to_nodes(self.create_message(d))
+        self.node.send_to_nodes(self.create_message(d), key='block_height')
 
     def broadcast_tx(self, tx, ex=None):
         """
-        Sends a transaction to our peers.
+        Announces a transaction to our peers.
         :param tx: Transaction
         :param ex: Node - The node that we don't want to send the transaction back to
         :return: None
         """
-        d = {'new_tx': tx.get_sending_form()}
-        if ex is not None:
-            self.node.send_to_nodes(self.create_message(d), [ex])
-        else:
-            self.node.send_to_nodes(self.create_message(d))
+        self.announce('tx', [tx.txid], ex)
 
     def send_memory_pool(self, n):
         """
@@ -212,6 +510,7 @@ class NodeHandler(threading.Thread):
             transactions.append(self.create_transaction(tx))
 
         new_block = Block(b['previous_hash'], transactions, b['difficulty'], b['height'])
+        new_block.version = b.get('version', 1)  # Nodes running older versions don't send the block's version
         new_block.nonce = b['nonce']
         new_block.timestamp = b['timestamp']
         if new_block.generate_hash() == b['hash']:
@@ -224,6 +523,19 @@ class NodeHandler(threading.Thread):
             self.debug_print('Handler: Incorrectly Built BLock')
         return False
 
+    def create_header(self, h):
+        """
+        Converts a header dictionary into a Block object without transactions.
+        :param h: dict
+        :return: Block
+        """
+        header = Block(h['previous_hash'], [], h['difficulty'], h['height'], version=h['version'])
+        header.nonce = h['nonce']
+        header.timestamp = h['timestamp']
+        header.merkle_root = h['merkle_root']
+        header.hash = h['hash']
+        return header
+
     def create_transaction(self, tx):  # tx is a transaction in dictionary form
         """
         Convers transaction dictionary into a Transaction object.
@@ -264,14 +576,41 @@ class NodeHandler(threading.Thread):
         msg = json.loads(data)
         items = [i[0] for i in msg.items()]
         try:
+            if 'inv' in items:
+                self.request_inventory(n, msg['inv'])
+
+            if 'get_data' in items:
+                self.send_inventory(n, msg['get_data'])
+
             if 'new_block' in items:
                 self.debug_print('Recieved New Block')
-                if self.create_block(msg['new_block']):
-                    self.broadcast_block(n)
+                n.known_inventory.add(msg['new_block']['hash'])
+                self.requested.pop(msg['new_block']['hash'], None)
+                if self.seen.check(msg['new_block']['hash']):
+                    self.debug_print('Handler: Block has already been added')
+                else:
+                    self.receive_block(n, msg['new_block'])
+
+            if 'cmpct_block' in items:
+                n.known_inventory.add(msg['cmpct_block']['hash'])
+                self.requested.pop(msg['cmpct_block']['hash'], None)
+                if self.seen.check(msg['cmpct_block']['hash']):
+                    self.debug_print('Handler: Block has already been added')
+                else:
+                    self.rebuild_block(n, msg['cmpct_block'])
+
+            if 'get_block_txs' in items:
+                self.send_block_transactions(n, msg['get_block_txs'])
+
+            if 'block_txs' in items:
+                self.block_transactions_received(n, msg['block_txs'])
 
             if 'new_tx' in items:
-                tx = self.create_transaction(msg['new_tx'])
-                self.blockchain.add_transaction(tx, n)
+                n.known_inventory.add(msg['new_tx']['txid'])
+                self.requested.pop(msg['new_tx']['txid'], None)
+                if not self.seen.check(msg['new_tx']['txid']):
+                    tx = self.create_transaction(msg['new_tx'])
+                    self.blockchain.add_transaction(tx, n)
 
             if 'peers' in items:
                 new = [p for p in msg['peers'] if p not in self.peers and p != self.IP and p not in self.known_peers]
@@ -287,7 +626,10 @@ class NodeHandler(threading.Thread):
                 n.services = array[1]
                 n.blockheight = array[2]
                 if array[2] > self.blockchain.block_height:
-                    self.get_blocks(n)
+                    if not self.can_sync_headers(n):
+                        self.get_blocks(n)
+                    elif not self.sync.start(n, array[2]):
+                        self.debug_print('Handler: Already syncing, blocks will also be downloaded from this node')
                 else:
                     self.request_memory_pool(n)
 
@@ -314,21 +656,36 @@ class NodeHandler(threading.Thread):
 
             if 'get_blocks' in items:
                 if msg['get_blocks'][0] <= self.blockchain.block_height-8:
-                    blocks = [self.blockchain.database.block_from_height(i).get_sending_form() for i in range(msg['get_blocks'][0]+1,msg['get_blocks'][0]+8)]
-
+                    last = msg['get_blocks'][0]+7
                 else:
-                    blocks = [self.blockchain.database.block_from_height(i).get_sending_form() for i in range(msg['get_blocks'][0]+1,self.blockchain.block_height+1)]
+                    last = self.blockchain.block_height
 
-                d = {'blocks': blocks}
-                m = self.create_message(d)
+                blocks = self.blockchain.database.get_raw_blocks(msg['get_blocks'][0]+1, last, MAX_REPLY_BYTES)
+                self.node.send_to_node(n, self.create_blocks_message(blocks))
 
-                self.node.send_to_node(n, m)
+            if 'get_headers' in items:
+                first = msg['get_headers'] + 1
+                headers = self.blockchain.database.get_headers(first, first + MAX_HEADERS - 1)
+                self.node.send_to_node(n, self.create_message({'headers': headers}))
+
+            if 'headers' in items:
+                self.sync.headers_received(n, msg['headers'])
+
+            if 'get_bodies' in items:
+                first, last = msg['get_bodies']
+                blocks = self.blockchain.database.get_raw_blocks(first, min(last, first + 4 * WINDOW - 1),
+                                                                 MAX_REPLY_BYTES)
+                self.node.send_to_node(n, self.create_raw_message('bodies', b'[' + b', '.join(blocks) + b']'))
+
+            if 'bodies' in items:
+                self.sync.bodies_received(n, msg['bodies'])
 
             if 'blocks' in items:
                 h = self.blockchain.block_height
                 blocks = msg['blocks']
                 for block in blocks:
-                    self.create_block(block)
+                    if not self.seen.check(block['hash']):
+                        self.create_block(block)
 
                 if n.blockheight > self.blockchain.block_height and self.attempts < 4:  # Stops and infinite loop
                     if self.blockchain.block_height == h:
@@ -345,7 +702,8 @@ class NodeHandler(threading.Thread):
 
             if 'mem_pool' in items:
                 for tx in msg['mem_pool']:
-                    self.blockchain.add_transaction(self.create_transaction(tx))
+                    if not self.seen.check(tx['txid']):
+                        self.blockchain.add_transaction(self.create_transaction(tx))
 
         except Exception as e:
             print(e)
@@ -353,14 +711,46 @@ class NodeHandler(threading.Thread):
 
     def callback(self, event, node, other, data):
         """
-        Callback method for the main node. A way of handling new/broken connections and messages.
+        Callback method for the main node. Called by the node's event loop, so events are queued for the event thread
+        rather than handled here. Printing and recording when we last sent a message are quick, so they aren't queued.
         :param event: string
-        :param node:
+        :param node: Node
+        :param other: Connection
+        :param data: string
+        :return: None
+        """
+        if 'print' == event:
+            self.debug_print(data)
+        elif 'update_last_send' == event:
+            self.GUI.sent = time.ctime(self.node.last_send/1e9)
+        else:
+            self.events.put((event, node, other, data))
+
+    def process_events(self):
+        """
+        Main loop of the event thread. Handles the node's events in the order they happened, until the node stops.
+        :return: None
+        """
+        while True:
+            event, node, other, data = self.events.get()
+            if 'node_stopped' == event:
+                return
+            try:
+                self.handle_event(event, node, other, data)
+            except Exception as e:  # One bad message mustn't stop every later message from being handled
+                self.debug_print('Handler: Error handling ' + event + ' event: ' + repr(e))
+
+    def handle_event(self, event, node, other, data):
+        """
+        A way of handling new/broken connections and messages. Called by the event thread.
+        :param event: string
+        :param node: Node
         :param other: Connection
         :param data: string
         :return: None
         """
         if 'disconnected' in event:
+            self.sync.peer_disconnected(other)
             self.peers.remove(other.host)
             l = len(self.peers)
             self.GUI.connections = str(l)
@@ -408,11 +798,9 @@ class NodeHandler(threading.Thread):
             self.known_peers.pop(0)
             self.establish_connection_with_network()
 
-        elif 'print' == event:
-            self.debug_print(data)
-
-        elif 'update_last_send' == event:
-            self.GUI.sent = time.ctime(self.node.last_send/1e9)
+        elif 'tick' == event:  # Called every second by the main node
+            self.sync.check_timeouts()
+            self.check_requests()
 
     def get_node(self, id):
         """
@@ -428,15 +816,19 @@ class NodeHandler(threading.Thread):
                 return n
 
     def block_mined(self):  # Called when we mine a block
+        self.seen.add(self.blockchain.get_last_block().hash)
         self.GUI.update_blockchain()
         self.broadcast_block()
         self.broadcast_blockheight()
 
     def block_added(self):  # Called when we add a block that we haven't mined
-        self.GUI.update_blockchain()
-        self.broadcast_blockheight()
+        self.seen.add(self.blockchain.get_last_block().hash)
+        if not self.sync.is_syncing():  # Peers are told our height once the sync has finished
+            self.GUI.update_blockchain()
+            self.broadcast_blockheight()
 
     def tx_added(self, tx, ex):  # Called when we add a transaction to our memory pool
+        self.seen.add(tx.txid)
         self.broadcast_tx(tx, ex)
         self.GUI.update_blockchain()
 
@@ -1,9 +1,11 @@
 from app import VoterApp
 import os, sys
+import multiprocessing
 from kivy.resources import resource_add_path
 
 
 if __name__ == '__main__':
+    multiprocessing.freeze_support()  # Needed for the mining processes when the app is frozen into an executable
     if getattr(sys, 'frozen', False):
         application_path = os.path.dirname(sys.executable)
     elif __file__:
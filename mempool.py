@@ -0,0 +1,149 @@
+"""
+MemoryPool object stores the transactions that are waiting to be mined.
+
+Transactions are indexed by their TXID, and every output that they spend is mapped to the transaction spending it, so
+duplicates and double spends are found without looking through the whole pool. A heap keeps the transactions in the
+order of their timestamps for building blocks. Transactions are also indexed by their short TXIDs, so blocks sent in
+compact form can be rebuilt from the pool.
+"""
+
+import heapq
+import itertools
+import threading
+from block import short_txid
+
+
+class MemoryPool:
+    def __init__(self):
+        self.transactions = {}  # TXID -> Transaction
+        self.spent = {}  # (TXID, index) of a spent output -> TXID of the transaction spending it
+        self.heap = []  # [timestamp, sequence number, TXID] of every transaction. Out of date entries are skipped
+        self.sequence = {}  # TXID -> Sequence number of the transaction's current heap entry
+        self.counter = itertools.count()  # A transaction that is removed and added again gets a new sequence number
+        self.short_ids = {}  # Short TXID -> TXID
+        self.lock = threading.Lock()  # Transactions are added and removed by the network and mining threads
+
+    def __len__(self):
+        return len(self.transactions)
+
+    def __contains__(self, txid):
+        return txid in self.transactions
+
+    def __iter__(self):
+        with self.lock:
+            return iter(list(self.transactions.values()))
+
+    def get(self, txid):
+        """
+        Gets a transaction from its TXID.
+        :param txid: string
+        :return: Transaction or None
+        """
+        return self.transactions.get(txid)
+
+    def get_by_short_id(self, short_id):
+        """
+        Gets a transaction from its short TXID.
+        :param short_id: string
+        :return: Transaction or None
+        """
+        txid = self.short_ids.get(short_id)
+        if txid is None:
+            return None
+        return self.transactions.get(txid)
+
+    def is_spent(self, txid, index):
+        """
+        Checks whether an output is spent by a transaction in the pool.
+        :param txid: string
+        :param index: int
+        :return: Bool
+        """
+        return (txid, index) in self.spent
+
+    def get_conflicts(self, tx):
+        """
+        Finds the transactions in the pool that spend any of the same outputs as a transaction.
+        :param tx: Transaction
+        :return: List of strings - TXIDs of the conflicting transactions
+        """
+        conflicts = []
+        for i in tx.inputs:
+            spender = self.spent.get((i['txid'], i['index']))
+            if spender is not None and spender != tx.txid and spender not in conflicts:
+                conflicts.append(spender)
+        return conflicts
+
+    def add(self, tx):
+        """
+        Adds a transaction to the pool.
+        :param tx: Transaction
+        :return: Bool - False if the transaction is already in the pool or spends an output that is already spent
+        """
+        with self.lock:
+            if tx.txid in self.transactions or self.get_conflicts(tx):
+                return False
+
+            self.transactions[tx.txid] = tx
+            for i in tx.inputs:
+                self.spent[(i['txid'], i['index'])] = tx.txid
+            self.sequence[tx.txid] = next(self.counter)
+            heapq.heappush(self.heap, [tx.timestamp, self.sequence[tx.txid], tx.txid])
+            self.short_ids.setdefault(short_txid(tx.txid), tx.txid)  # Only the first of two colliding TXIDs is indexed
+            return True
+
+    def remove(self, txid):
+        """
+        Removes a transaction from the pool.
+        :param txid: string
+        :return: Bool - False if the transaction wasn't in the pool
+        """
+        with self.lock:
+            tx = self.transactions.pop(txid, None)
+            if tx is None:
+                return False
+            del self.sequence[txid]
+
+            for i in tx.inputs:
+                if self.spent.get((i['txid'], i['index'])) == txid:
+                    del self.spent[(i['txid'], i['index'])]
+            if self.short_ids.get(short_txid(txid)) == txid:
+                del self.short_ids[short_txid(txid)]
+
+            if len(self.heap) > 2 * len(self.transactions) + 64:  # Stops removed entries building up in the heap
+                self.heap = [entry for entry in self.heap if self.is_current(entry)]
+                heapq.heapify(self.heap)
+            return True
+
+    def remove_transactions(self, transactions):
+        """
+        Removes transactions that have been mined, along with any transactions in the pool that spend the same outputs.
+        :param transactions: List of Transactions
+        :return: None
+        """
+        for tx in transactions:
+            self.remove(tx.txid)
+            for conflict in self.get_conflicts(tx):
+                self.remove(conflict)
+
+    def is_current(self, entry):
+        """
+        Checks whether a heap entry belongs to a transaction that is in the pool, and isn't left over from an earlier
+        time that the transaction was in the pool.
+        :param entry: [timestamp, sequence number, TXID]
+        :return: Bool
+        """
+        return self.sequence.get(entry[2]) == entry[1]
+
+    def get_oldest(self, n):
+        """
+        Gets the transactions in the pool with the smallest timestamps.
+        :param n: int
+        :return: List of Transactions - In order of their timestamps
+        """
+        with self.lock:
+            oldest = []
+            for entry in heapq.nsmallest(n + len(self.heap) - len(self.transactions), self.heap):
+                if self.is_current(entry) and len(oldest) < n:
+                    oldest.append(self.transactions[entry[2]])
+            return oldest
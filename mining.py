@@ -0,0 +1,255 @@
+"""
+MiningEngine object searches the nonce space of a block using a pool of worker processes.
+
+Every worker is given its own ranges of nonces, so no two processes ever try the same nonce. The first worker to find a
+valid hash retires the job, which stops the other workers.
+
+The nonce is the last thing in a block's header, so each worker hashes the rest of the header once and then copies that
+hash state for every nonce it tries. The cost of an attempt doesn't depend on how many transactions are in the block.
+"""
+
+import multiprocessing
+import os
+import queue
+import time
+from hashlib import sha256
+
+
+def nonce_bytes(nonce):
+    """
+    Converts a nonce into the bytes that end a block's header.
+    :param nonce: int
+    :return: bytes
+    """
+    return nonce.to_bytes(8, 'big')
+
+
+def scan(midstate, target, start, stop):
+    """
+    Tries every nonce in the range [start, stop).
+    :param midstate: sha256 object - Hash of the header data that comes before the nonce
+    :param target: int - Largest value that a valid hash can have
+    :param start: int
+    :param stop: int
+    :return: int or None - The first valid nonce in the range
+    """
+    for nonce in range(start, stop):
+        h = midstate.copy()
+        # Same as nonce_bytes(nonce), which Block uses. It is inlined because a call for every nonce tried costs a few
+        # percent of the hashrate
+        h.update(nonce.to_bytes(8, 'big'))
+        if int.from_bytes(h.digest(), 'big') <= target:
+            return nonce
+    return None
+
+
+def search_nonces(worker, workers, jobs, results, job_id, hashes, nonce_range, check_interval):
+    """
+    Main loop of a worker process.
+    Worker n searches ranges n, n + workers, n + 2*workers ... of the nonce space until the job is retired.
+    :param worker: int - Index of this worker
+    :param workers: int - Number of workers in the pool
+    :param jobs: Queue - Jobs sent to this worker
+    :param results: Queue - Shared queue that valid nonces are put on
+    :param job_id: Value - Number of the job that is currently being mined
+    :param hashes: Value - Number of nonces that the pool has tried
+    :param nonce_range: int - Number of nonces in a range
+    :param check_interval: int - Number of nonces tried before checking if the job has been retired
+    :return: None
+    """
+    while True:
+        job = jobs.get()
+        if job is None:  # Sent when the engine shuts down
+            return
+
+        number, prefix, target = job
+        midstate = sha256(prefix)
+        r = worker  # Index of the range being searched
+        nonce = None
+        while nonce is None and job_id.value == number:
+            for start in range(r * nonce_range, (r + 1) * nonce_range, check_interval):
+                nonce = scan(midstate, target, start, start + check_interval)
+                with hashes.get_lock():
+                    hashes.value += check_interval if nonce is None else nonce - start + 1
+                if nonce is not None or job_id.value != number:
+                    break
+            r += workers
+
+        if nonce is not None:
+            with job_id.get_lock():
+                if job_id.value == number:  # Only the first worker to find a nonce reports it
+                    job_id.value += 1  # Retires the job, so the other workers stop
+                    results.put((number, nonce))
+
+
+class MiningStats:
+    """
+    Records how quickly the device is mining. Used for sizing mining hardware and for tuning the difficulty.
+    """
+    def __init__(self, hashes):
+        self.hashes = hashes  # Shared Value that the workers add the number of nonces they have tried to
+        self.hashrate = 0  # Hashes per second between the last two samples
+        self.blocks_found = 0
+        self.aborted_blocks = 0  # Blocks abandoned because a block from another node was added first
+        self.last_block_time = 0  # Seconds taken to find the last block
+        self.total_block_time = 0  # Seconds taken to find every block that has been found
+
+        self.block_start = None  # [time, nonces tried] when the current block started being mined
+        self.last_sample = [time.monotonic(), 0]  # [time, nonces tried] when sample() was last called
+
+    def get_nonces_tried(self):
+        """
+        Gets the number of nonces that have been tried since the engine was created.
+        :return: int
+        """
+        return self.hashes.value
+
+    def get_block_nonces(self):
+        """
+        Gets the number of nonces that have been tried for the block that is being mined.
+        :return: int
+        """
+        if self.block_start is None:
+            return 0
+        return self.get_nonces_tried() - self.block_start[1]
+
+    def get_average_block_time(self):
+        """
+        Gets the average number of seconds taken to find a block.
+        :return: float
+        """
+        if self.blocks_found == 0:
+            return 0
+        return self.total_block_time / self.blocks_found
+
+    def sample(self):
+        """
+        Updates the hashrate from the nonces tried since the last sample.
+        Called regularly by the GUI.
+        :return: float - Hashes per second
+        """
+        t = time.monotonic()
+        n = self.get_nonces_tried()
+        if t > self.last_sample[0]:
+            self.hashrate = (n - self.last_sample[1]) / (t - self.last_sample[0])
+        self.last_sample = [t, n]
+        return self.hashrate
+
+    def block_started(self):
+        """
+        Called when a block starts being mined.
+        :return: None
+        """
+        self.block_start = [time.monotonic(), self.get_nonces_tried()]
+
+    def block_found(self):
+        """
+        Called when a valid nonce is found for a block.
+        :return: None
+        """
+        if self.block_start is not None:
+            self.last_block_time = time.monotonic() - self.block_start[0]
+            self.total_block_time += self.last_block_time
+        self.blocks_found += 1
+
+    def get_dictionary_form(self):
+        """
+        Returns the dictionary form of the statistics.
+        :return: dict
+        """
+        return {'hashrate': self.hashrate, 'nonces_tried': self.get_nonces_tried(),
+                'block_nonces': self.get_block_nonces(), 'blocks_found': self.blocks_found,
+                'aborted_blocks': self.aborted_blocks, 'last_block_time': self.last_block_time,
+                'average_block_time': self.get_average_block_time()}
+
+
+class MiningEngine:
+    def __init__(self, workers=None, nonce_range=2 ** 32, check_interval=2 ** 12):
+        self.workers = workers if workers is not None else os.cpu_count() or 1
+        self.nonce_range = nonce_range
+        self.check_interval = check_interval
+
+        # Spawn avoids forking the threads of the GUI and the network into every worker
+        self.context = multiprocessing.get_context('spawn')
+        self.job_id = self.context.Value('q', 0)
+        self.hashes = self.context.Value('Q', 0)
+        self.stats = MiningStats(self.hashes)
+        self.results = self.context.Queue()
+        self.queues = []  # One job queue per worker
+        self.processes = []
+
+    def start(self):
+        """
+        Starts the worker processes if they are not already running.
+        :return: None
+        """
+        if self.processes:
+            return
+
+        for n in range(self.workers):
+            q = self.context.Queue()
+            p = self.context.Process(target=search_nonces, daemon=True,
+                                     args=(n, self.workers, q, self.results, self.job_id, self.hashes,
+                                           self.nonce_range, self.check_interval))
+            p.start()
+            self.queues.append(q)
+            self.processes.append(p)
+
+    def submit(self, prefix, target):
+        """
+        Retires the current job and gives every worker a new one.
+        :param prefix: bytes - Header data that comes before the nonce
+        :param target: int - Largest value that a valid hash can have
+        :return: int - Number of the new job
+        """
+        self.start()
+        with self.job_id.get_lock():
+            self.job_id.value += 1
+            number = self.job_id.value
+
+        for q in self.queues:
+            q.put((number, prefix, target))
+        return number
+
+    def get_result(self, number, timeout=None):
+        """
+        Waits for a worker to find a nonce for a job.
+        Results of older jobs are thrown away.
+        :param number: int - Number of the job
+        :param timeout: float
+        :return: int or None - The nonce, or None if none was found in time
+        """
+        try:
+            while True:
+                n, nonce = self.results.get(timeout=timeout)
+                if n == number:
+                    return nonce
+        except queue.Empty:
+            return None
+
+    def cancel(self, number):
+        """
+        Retires a job, which stops all of the workers that are mining it.
+        :param number: int
+        :return: None
+        """
+        with self.job_id.get_lock():
+            if self.job_id.value == number:
+                self.job_id.value += 1
+
+    def shutdown(self):
+        """
+        Stops the worker processes.
+        Called when the app is closed.
+        :return: None
+        """
+        self.cancel(self.job_id.value)
+        for q in self.queues:
+            q.put(None)
+        for p in self.processes:
+            p.join(1)
+            if p.is_alive():
+                p.terminate()
+
+        self.queues = []
+        self.processes = []
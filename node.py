@@ -1,3 +1,4 @@
+import selectors
 import socket
 import threading
 from hashlib import sha512
@@ -9,8 +10,11 @@ class Node(threading.Thread):
     """
     The Node object acts a server and it is what inbound connections connect to.
     It also manages all connections made.
+    Every socket, including the one that listens for new connections, is run by one event loop on the Node's thread.
+    Other threads hand work to the loop by adding it to a list and waking the loop up. Messages are passed to the
+    callback, which handles them on another thread, so the loop only reads and writes sockets.
     """
-    def __init__(self, host, port, callback=None):
+    def __init__(self, host, port, callback=None, queue_limit=4 * 2 ** 20, queue_policy='drop'):
         super(Node, self).__init__()
 
         self.terminate_flag = threading.Event()
@@ -37,6 +41,23 @@ class Node(threading.Thread):
         self.last_send = 0e9  # Time when we last sent a message
         self.last_recv = 0e9  # Time when we last received a message
 
+        self.selector = selectors.DefaultSelector()
+        self.waker, self.wake_socket = socket.socketpair()  # Writing to wake_socket interrupts the event loop
+        self.waker.setblocking(False)
+        self.wake_socket.setblocking(False)
+        self.woken = []  # Connections that have been added, or have bytes to send, or are stopping
+        self.lock = threading.Lock()
+
+        self.queue_limit = queue_limit  # Bytes that can wait to be sent to each connection
+        # What happens to a message sent to a connection whose queue is full:
+        #     'drop' - The message is thrown away
+        #     'disconnect' - The connection is closed, as the peer isn't keeping up
+        #     'coalesce' - The message replaces a queued message with the same key. If there isn't one, a message with a key
+        #                  is thrown away, and the connection is closed for a message without one
+        self.queue_policy = queue_policy
+
+        self.last_tick = time.monotonic()  # Time when the callback was last told that a second had passed
+
     def debug_print(self, msg):
         """
         Method for printing
@@ -54,8 +75,8 @@ class Node(threading.Thread):
         try:
             self.debug_print('Node: Initialising of the Node on port: ' + str(self.port) + ' with host: ' + str(self.host))
             self.s.bind((self.host, self.port))
-            self.s.settimeout(10.0)
-            self.s.listen(1)
+            self.s.setblocking(False)
+            self.s.listen(128)
             self.flag = True
         except OSError as e:
             self.debug_print(('Node:  Error Initialising Node ' + str(e)))
@@ -74,7 +95,7 @@ class Node(threading.Thread):
             return False
 
         for node in self.outbound_nodes:
-            if node.host == host and node.PORT == port:
+            if node.host == host and node.port == port:
                 self.debug_print('Node: Already connected to node')
                 return False
 
@@ -84,15 +105,8 @@ class Node(threading.Thread):
             self.debug_print("Node: Connecting to %s on port %s" % (host, port))
             sock.connect((host, port))
 
-            sock.send(self.id.encode('utf-8'))
-            connected_node_id = str(sock.recv(4096).decode('utf-8'))
-            time.sleep(0.1)
-            server_thread = self.create_connection(sock, connected_node_id, host, port, 1)
-            server_thread.start()
-
-            self.outbound_nodes.append(server_thread)
-            self.outbound_node_connected(server_thread)
-
+            # outbound_node_connected is called by the event loop once the other node has sent its ID
+            self.wake(self.create_connection(sock, None, host, port, 1))
             return True
 
         except socket.timeout:
@@ -109,18 +123,14 @@ class Node(threading.Thread):
         :param node: Connection
         :return: None
         """
-        if node in self.outbound_nodes:
-            node.stop()
-            self.outbound_nodes.remove(node)
-        elif node in self.inbound_nodes:
+        if node in self.outbound_nodes or node in self.inbound_nodes:
             node.stop()
-            self.inbound_nodes.remove(node)
         else:
             self.debug_print('Node: Cannot disconnect from node we are not connected to')
 
     def create_connection(self, connection, id, host, port, ty):
         """
-        Creates a Connection object for a newly connected inbound node.
+        Creates a Connection object for a newly connected node, and sends it our ID.
         :param connection: Socket
         :param id: string
         :param host: string
@@ -129,13 +139,139 @@ class Node(threading.Thread):
         :return: Connection
         """
         self.nodeip = host  # ip address of the other node
-        return Connection(self, connection, id, host, port, ty)
+        c = Connection(self, connection, id, host, port, ty)
+        c.send(self.id, 'id')
+        return c
+
+    def wake(self, connection):
+        """
+        Asks the event loop to look at a connection. Can be called from any thread.
+        :param connection: Connection
+        :return: None
+        """
+        with self.lock:
+            self.woken.append(connection)
+        try:
+            self.wake_socket.send(b'\0')
+        except BlockingIOError:
+            pass  # The loop has already been woken
+
+    def accept(self):
+        """
+        Accepts the nodes that are connecting to us. Called by the event loop.
+        :return: None
+        """
+        while True:
+            try:
+                c, a = self.s.accept()
+            except BlockingIOError:
+                return
+            self.debug_print("Node: Connection received from " + str(a[0]))
+            self.register(self.create_connection(c, None, a[0], a[1], 0))
 
-    def send_to_nodes(self, data, exclude=None):
+    def register(self, connection):
+        """
+        Starts watching a connection's socket. Called by the event loop.
+        :param connection: Connection
+        :return: None
+        """
+        try:
+            self.selector.register(connection.sock, selectors.EVENT_READ, connection)
+        except (KeyError, ValueError):
+            pass  # Already registered, or the socket has been closed
+
+    def close_connection(self, connection):
+        """
+        Closes a connection. Called by the event loop.
+        :param connection: Connection
+        :return: None
+        """
+        connection.terminate_flag.set()
+        try:
+            self.selector.unregister(connection.sock)
+        except (KeyError, ValueError):
+            pass
+        connection.sock.close()
+
+        if connection in self.outbound_nodes:
+            self.outbound_nodes.remove(connection)
+        if connection in self.inbound_nodes:
+            self.inbound_nodes.remove(connection)
+
+        if connection.connected:
+            self.debug_print('Connection: Connection Stopped with host {}'.format(connection.host))
+            self.node_disconnected(connection)
+        elif connection.type == 1:
+            self.debug_print("Node: Couldn't connect with node: No ID received")
+            self.failed_to_connect()
+
+    def handle_woken(self):
+        """
+        Registers new connections, starts watching for connections becoming writable when they have bytes waiting to
+        be sent, and closes stopped connections. Called by the event loop.
+        :return: None
+        """
+        while True:
+            try:
+                if not self.waker.recv(4096):
+                    break
+            except BlockingIOError:
+                break
+
+        with self.lock:
+            woken, self.woken = self.woken, []
+
+        for c in woken:
+            if c.sock.fileno() == -1:
+                continue  # Already closed
+            self.register(c)
+            if c.terminate_flag.is_set() and c.flush():
+                self.close_connection(c)
+            elif c.has_outgoing():
+                self.selector.modify(c.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, c)
+
+    def handle_event(self, key, events):
+        """
+        Handles a socket that the selector says is ready. Called by the event loop.
+        :param key: SelectorKey
+        :param events: int - Mask of the events that are ready
+        :return: None
+        """
+        if key.fileobj is self.s:
+            self.accept()
+        elif key.fileobj is self.waker:
+            self.handle_woken()
+        else:
+            c = key.data
+            if events & selectors.EVENT_READ and not c.receive():
+                self.close_connection(c)
+            elif events & selectors.EVENT_WRITE and c.flush():
+                if c.terminate_flag.is_set():
+                    self.close_connection(c)
+                else:
+                    self.selector.modify(c.sock, selectors.EVENT_READ, c)
+
+    def node_connected(self, connection):
+        """
+        Called by a connection once it has received the other node's ID.
+        :param connection: Connection
+        :return: None
+        """
+        self.debug_print('Node: Connected Node Id:' + str(connection.id))
+        if connection.type == 1:
+            self.outbound_nodes.append(connection)
+            self.outbound_node_connected(connection)
+        else:
+            self.inbound_nodes.append(connection)
+            self.inbound_node_connected(connection)
+
+    def send_to_nodes(self, data, exclude=None, key=None):
         """
         Send a message to multiple nodes.
+        Messages are queued for each node, so a slow node doesn't hold up the others.
         :param data: JSON dictionary
         :param exclude: List of Connections - Connections that we don't want to send message to
+        :param key: string - See Connection.send
         :return:
         """
         if exclude is None:
@@ -143,25 +279,41 @@ class Node(threading.Thread):
 
         for n in self.inbound_nodes:
             if n not in exclude:
-                self.send_to_node(n, data)
+                self.send_to_node(n, data, key)
 
         for n in self.outbound_nodes:
             if n not in exclude:
-                self.send_to_node(n, data)
+                self.send_to_node(n, data, key)
 
-    def send_to_node(self, n, d):
+    def send_to_node(self, n, d, key=None):
         """
         Sends a message to a node
         :param n: Connection
         :param d: JSON dictionary
+        :param key: string - See Connection.send
         :return: None
         """
         if n in self.inbound_nodes or n in self.outbound_nodes:
-            n.send(d)
-            self.sent += 1
+            if n.send(d, key=key):
+                self.sent += 1
         else:
             self.debug_print('Node: Cannot find node to send to')
 
+    def get_queue_stats(self):
+        """
+        Gets the state of the send queues of our connections. Used for displaying information in the UI.
+        :return: dict
+        """
+        nodes = self.inbound_nodes + self.outbound_nodes
+        depths = [n.get_queue_depth() for n in nodes]
+        dropped_kinds = {}
+        for n in nodes:
+            for kind, count in list(n.dropped_kinds.items()):
+                dropped_kinds[kind] = dropped_kinds.get(kind, 0) + count
+        return {'depth': sum(depths), 'max_depth': max(depths, default=0),
+                'bytes': sum([n.queued_bytes for n in nodes]), 'dropped': sum([n.dropped for n in nodes]),
+                'dropped_kinds': dropped_kinds, 'coalesced': sum([n.coalesced for n in nodes])}
+
     def get_nodes(self):
         """
         Returns arrays of the string formats of our connection.
@@ -175,44 +327,41 @@ class Node(threading.Thread):
     def run(self):
         """
         Main Loop of the Thread.
-        The Node constantly listens for new nodes that are connecting to us.
+        Waits for new nodes connecting to us, messages arriving and sockets becoming writable, and handles them as they
+        happen.
         :return: None
         """
+        self.debug_print("Node:  Waiting for connections")
+        self.selector.register(self.s, selectors.EVENT_READ)
+        self.selector.register(self.waker, selectors.EVENT_READ)
+
         while not self.terminate_flag.is_set():
             try:
-                self.debug_print("Node:  Waiting for connections")
-                c, a = self.s.accept()
-                connected_node_id = c.recv(4096).decode('utf-8')
-                self.debug_print('Node: Connected Node Id:' + str(connected_node_id))
-                c.send(self.id.encode('utf-8'))
-                self.debug_print("Node: Connection received from " + str(a[0]))
-                time.sleep(0.1)
-                client_thread = self.create_connection(c, connected_node_id, a[0], a[1], 0)
-                client_thread.start()
-
-                self.inbound_nodes.append(client_thread)
-                self.inbound_node_connected(client_thread)
-
-            except socket.timeout:
-                pass
+                for key, events in self.selector.select(timeout=1):  # The timeout lets terminate_flag be checked
+                    try:
+                        self.handle_event(key, events)
+                    except Exception as e:  # An error with one socket mustn't stop the loop for every other socket
+                        self.debug_print('Node: Error in the event loop: ' + repr(e))
+                        if isinstance(key.data, Connection):
+                            self.close_connection(key.data)
+
+                if time.monotonic() - self.last_tick >= 1:  # Lets the handler check for requests that have timed out
+                    self.last_tick = time.monotonic()
+                    try:
+                        self.tick()
+                    except Exception as e:
+                        self.debug_print('Node: Error in the event loop: ' + repr(e))
 
             except KeyboardInterrupt:  # Allows for a clean termination of the program
                 self.terminate_flag.set()
 
-            except Exception as e:
-                raise e
-
         self.debug_print("Node: Stopping Node")
-        out = self.outbound_nodes
-        inbound = self.inbound_nodes
-        for p in out:
-            p.stop()
-            self.outbound_nodes.remove(p)
-        for p in inbound:
-            p.stop()
-            self.inbound_nodes.remove(p)
-        time.sleep(1)
+        for key in list(self.selector.get_map().values()):
+            if isinstance(key.data, Connection):
+                key.data.flush()  # Sends the disconnect message if it fits in the socket's buffer
+                self.close_connection(key.data)
 
+        self.selector.close()
         self.s.close()
         self.debug_print("Node:Node Stopped")
         self.node_stopped()
@@ -240,6 +389,10 @@ class Node(threading.Thread):
             self.callback('node_message', self, node, msg)
             self.received += 1
 
+    def tick(self):
+        if self.callback:
+            self.callback('tick', self, None, {})
+
     def print_message(self, msg):
         if self.callback:
             self.callback('print', self, None, msg)
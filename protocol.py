@@ -0,0 +1,72 @@
+"""
+Framing of the messages that are sent between nodes.
+
+Every message is sent as a frame: a fixed size header followed by the payload. The header holds
+    magic - 4 bytes that mark the start of a frame of this project's protocol
+    command - 12 bytes, the type of the payload, in ASCII padded with zeros
+    length - 4 bytes, the number of bytes in the payload, big-endian
+    checksum - 4 bytes, the first 4 bytes of the SHA-256 hash of the payload
+so the receiver knows exactly how many bytes to read, and nothing in a payload can be mistaken for the end of a message.
+"""
+
+import struct
+from hashlib import sha256
+
+MAGIC = b'VOTE'
+HEADER = struct.Struct('>4s12sI4s')
+HEADER_SIZE = HEADER.size  # 24 bytes
+MAX_PAYLOAD = 32 * 2 ** 20  # Larger frames are treated as a protocol error, so a peer can't make us allocate any size
+
+
+class FrameError(Exception):
+    """
+    Raised when a frame's header is invalid, or its payload doesn't match the checksum.
+    """
+
+
+def checksum(payload):
+    """
+    Gets the checksum of a payload.
+    :param payload: bytes-like object
+    :return: bytes
+    """
+    return sha256(payload).digest()[:4]
+
+
+def pack_frame(command, payload):
+    """
+    Creates a frame.
+    :param command: string
+    :param payload: bytes
+    :return: bytes
+    """
+    return HEADER.pack(MAGIC, command.encode('ascii'), len(payload), checksum(payload)) + payload
+
+
+def unpack_header(header):
+    """
+    Reads a frame's header.
+    :param header: bytes-like object - HEADER_SIZE bytes
+    :return: string, int, bytes - Command, payload length and checksum
+    """
+    magic, command, length, check = HEADER.unpack(header)
+    if magic != MAGIC:
+        raise FrameError('Bad magic ' + magic.hex())
+    if length > MAX_PAYLOAD:
+        raise FrameError('Payload of ' + str(length) + ' bytes is too large')
+    return command.rstrip(b'\0').decode('ascii'), length, check
+
+
+def get_message_kind(frame):
+    """
+    Gets the type of the message in a frame, for statistics: the first key of a JSON message, otherwise the command.
+    :param frame: bytes
+    :return: string
+    """
+    command = HEADER.unpack(frame[:HEADER_SIZE])[1].rstrip(b'\0').decode('ascii')
+    payload = bytes(frame[HEADER_SIZE:HEADER_SIZE + 64])
+    if command == 'json' and payload.startswith(b'{"'):
+        end = payload.find(b'"', 2)
+        if end != -1:
+            return payload[2:end].decode('utf-8', 'replace')
+    return command
@@ -0,0 +1,350 @@
+"""
+ChainSync object downloads the blocks that our peers have and we don't, headers first.
+
+The headers of the best peer's blocks are downloaded and checked first: each one has to follow the one before it, hash
+to its own hash and meet the difficulty that the chain requires. Headers are small, so thousands arrive in one message.
+
+Once the headers reach the peer's block height, the blocks' bodies are requested in windows of consecutive heights.
+The windows are shared between every peer that has them, with a few windows waiting for a reply from each peer at once.
+How long each peer takes to reply is measured, and each new window goes to the peer that should reply soonest. Peers
+that are much slower than the fastest aren't sent windows, and a window that isn't answered within the timeout is asked
+for again from a different peer, so one slow peer can't hold up the sync. Bodies are checked against the headers as
+soon as they arrive, and are kept until the blocks before them have been added, as blocks are added in order of height.
+"""
+
+import time
+
+MAX_HEADERS = 2000  # Headers sent in reply to one get_headers message
+WINDOW = 32  # Blocks requested in one get_bodies message
+MAX_WINDOWS = 4  # get_bodies requests that can be waiting for a reply from each peer at once
+# Bytes of blocks sent in reply to one get_bodies message. Replies to MAX_WINDOWS requests have to fit in the send queue
+# of a peer together, as a reply that doesn't fit disconnects the peer that asked for it
+MAX_REPLY_BYTES = 2 ** 19
+MAX_AHEAD = 1024  # Blocks past our last block that can be requested, so the bodies waiting to be added are limited
+TIMEOUT = 10  # Seconds after which a request is given to another peer
+SLOW_FACTOR = 4  # Peers that take this many times longer to reply than the fastest peer aren't sent requests
+
+
+class ChainSync:
+    def __init__(self, handler):
+        self.handler = handler  # NodeHandler that sends the requests and builds the blocks
+        self.blockchain = handler.blockchain
+
+        self.peer = None  # Connection that the headers are downloaded from
+        self.state = 'idle'  # 'headers' whilst headers are being downloaded, then 'blocks'
+        self.target = 0  # Block height of the peer
+        self.headers = []  # Checked headers (Blocks without transactions) that follow our last block
+        self.bodies = {}  # Height -> Dictionary form of a block that has arrived before the blocks before it
+        self.requested = {}  # First height of a window of bodies -> [Connection, last height, time requested]
+        self.missing = []  # [first height, last height, Connection that didn't send it] of windows to ask for again
+        self.next_height = 0  # Height of the first block that hasn't been requested
+        self.last_request = 0  # Time that headers were last requested
+        self.started = 0  # Time that the sync started
+        self.reassigned = 0  # Windows that were asked for again because a peer was too slow
+        self.latency = {}  # Connection -> Average number of seconds that it takes to reply to get_bodies
+
+    def debug_print(self, msg):
+        self.handler.debug_print(msg)
+
+    def is_syncing(self):
+        return self.state != 'idle'
+
+    def start(self, peer, height):
+        """
+        Starts downloading the chain of a peer that has more blocks than us.
+        :param peer: Connection
+        :param height: int - The peer's block height
+        :return: Bool - False if we are already syncing
+        """
+        if self.state != 'idle':
+            return False
+
+        self.debug_print('Sync: Downloading headers from ' + str(peer.id))
+        self.peer = peer
+        self.state = 'headers'
+        self.target = height
+        self.headers = []
+        self.bodies = {}
+        self.requested = {}
+        self.missing = []
+        self.started = time.monotonic()
+        self.reassigned = 0
+        self.request_headers()
+        return True
+
+    def stop(self, reason):
+        """
+        Stops syncing. The blocks that have been added are kept.
+        :param reason: string
+        :return: None
+        """
+        if self.state != 'idle':
+            self.debug_print('Sync: Stopped, ' + reason)
+        self.peer = None
+        self.state = 'idle'
+        self.headers = []
+        self.bodies = {}
+        self.requested = {}
+        self.missing = []
+        self.latency = {}
+        self.update_progress()
+
+    def restart(self, ex=None):
+        """
+        Starts syncing from the peer with the most blocks, if it has more blocks than us.
+        :param ex: Connection - A peer that we don't want to sync from
+        :return: Bool - False if no peer has more blocks than us
+        """
+        peers = [n for n in self.get_peers(self.blockchain.block_height + 1) if n is not ex]
+        if not peers:
+            return False
+        peer = max(peers, key=lambda n: n.blockheight)
+        return self.start(peer, peer.blockheight)
+
+    def get_peers(self, height):
+        """
+        Gets the peers that can send us the bodies of blocks up to a height.
+        :param height: int
+        :return: List of Connections
+        """
+        return [n for n in self.handler.node.inbound_nodes + self.handler.node.outbound_nodes
+                if n.connected and n.blockheight >= height and self.handler.can_sync_headers(n)]
+
+    def get_tip(self):
+        """
+        Gets the last block or header that we have.
+        :return: Block
+        """
+        if self.headers:
+            return self.headers[-1]
+        return self.blockchain.get_last_block()
+
+    def request_headers(self):
+        """
+        Asks the peer for the headers that follow the last header that we have.
+        :return: None
+        """
+        self.handler.send_sync_request(self.peer, {'get_headers': self.get_tip().height})
+        self.last_request = time.monotonic()
+        self.update_progress()
+
+    def check_header(self, header, chain):
+        """
+        Checks that a header can follow a chain of blocks and headers: its timestamp and difficulty have to be valid
+        before the headers after it are retargeted with them.
+        Blocks before version 3 hash their transactions rather than a Merkle root, so their hashes are checked when
+        their bodies arrive.
+        :param header: Block - Block without transactions
+        :param chain: List of Blocks - The end of the chain that the header follows
+        :return: Bool
+        """
+        previous = chain[-1]
+        if header.height != previous.height + 1 or header.previous_hash != previous.hash:
+            self.debug_print('Sync: Header ' + str(header.height) + " doesn't follow the chain")
+            return False
+        if header.version >= 3 and header.generate_hash() != header.hash:
+            self.debug_print("Sync: Problem with the hash of header " + str(header.height))
+            return False
+        if not self.blockchain.check_timestamp_and_difficulty(header, chain) or not header.meets_target():
+            self.debug_print('Sync: Header ' + str(header.height) + " doesn't meet the chain's rules")
+            return False
+        return True
+
+    def headers_received(self, peer, headers):
+        """
+        Checks and stores headers sent by the peer, and asks for more headers or the first bodies.
+        :param peer: Connection
+        :param headers: List of dicts
+        :return: None
+        """
+        if peer is not self.peer or self.state != 'headers':
+            return
+
+        # Enough of the chain to work out the difficulty of each new header
+        chain = self.blockchain.chain + self.headers[-self.blockchain.retarget_interval - 1:]
+        for h in headers:
+            header = self.handler.create_header(h)
+            if not self.check_header(header, chain):
+                self.stop('invalid header from ' + str(peer.id))
+                return
+            self.headers.append(header)
+            chain.append(header)
+            if len(chain) > 2 * self.blockchain.retarget_interval + 16:
+                del chain[:self.blockchain.retarget_interval]
+
+        tip = self.get_tip().height
+        self.target = max(self.target, tip)
+        if len(headers) == MAX_HEADERS and tip < self.target:
+            self.request_headers()
+        elif not self.headers:
+            self.finish()
+        else:
+            self.debug_print('Sync: Downloaded ' + str(len(self.headers)) + ' headers in {:.1f}s'.format(
+                time.monotonic() - self.started))
+            self.state = 'blocks'
+            self.target = tip
+            self.next_height = self.blockchain.block_height + 1
+            self.request_bodies()
+            self.update_progress()
+
+    def request_bodies(self):
+        """
+        Shares out the windows of bodies that haven't been requested between the peers that have them, until each
+        peer has MAX_WINDOWS waiting for a reply.
+        :return: None
+        """
+        waiting = {}  # Connection -> Number of windows that it hasn't replied to
+        for r in self.requested.values():
+            waiting[r[0]] = waiting.get(r[0], 0) + 1
+
+        limit = min(self.target, self.blockchain.block_height + MAX_AHEAD)
+        while True:
+            if self.missing:
+                first, last, slow = self.missing[0]
+            elif self.next_height <= limit:
+                first, last, slow = self.next_height, min(self.next_height + WINDOW - 1, limit), None
+            else:
+                return
+
+            peers = self.get_peers(last)
+            if len(peers) > 1 and slow in peers:
+                peers.remove(slow)  # The window is given to a different peer if there is one
+            fastest = min([self.latency[n] for n in peers if n in self.latency], default=0)
+            peers = [n for n in peers if waiting.get(n, 0) < MAX_WINDOWS
+                     and self.latency.get(n, 0) <= SLOW_FACTOR * fastest]  # Peers that haven't replied yet are tried
+            if not peers:
+                return
+
+            n = min(peers, key=lambda p: (waiting.get(p, 0) + 1) * self.latency.get(p, 0))
+            self.handler.send_sync_request(n, {'get_bodies': [first, last]})
+            self.requested[first] = [n, last, time.monotonic()]
+            waiting[n] = waiting.get(n, 0) + 1
+            if self.missing:
+                self.missing.pop(0)
+            else:
+                self.next_height = last + 1
+
+    def bodies_received(self, peer, blocks):
+        """
+        Stores the bodies sent by a peer, adds the ones that follow our last block, and asks for more.
+        :param peer: Connection
+        :param blocks: List of dicts - Dictionary forms of blocks, in order of height
+        :return: None
+        """
+        if self.state != 'blocks' or not blocks:
+            return  # A window that a peer can't send is asked for again when it times out
+
+        r = self.requested.get(blocks[0]['height'])
+        if r is not None and r[0] is peer:
+            del self.requested[blocks[0]['height']]
+            latency = time.monotonic() - r[2]
+            self.latency[peer] = 0.7 * self.latency.get(peer, latency) + 0.3 * latency
+            if blocks[-1]['height'] < r[1]:  # The peer only had some of the blocks, or they didn't fit in one reply
+                self.add_missing(blocks[-1]['height'] + 1, r[1], peer)
+
+        first = self.headers[0].height
+        for b in blocks:
+            i = b['height'] - first
+            if b['height'] > self.blockchain.block_height and 0 <= i < len(self.headers) \
+                    and self.headers[i].hash == b['hash']:
+                self.bodies[b['height']] = b
+
+        while self.blockchain.block_height + 1 in self.bodies:
+            if not self.handler.create_block(self.bodies.pop(self.blockchain.block_height + 1)):
+                self.stop('invalid block from ' + str(peer.id))
+                return
+
+        if self.blockchain.block_height >= self.target:
+            self.finish()
+        else:
+            self.request_bodies()
+            self.update_progress()
+
+    def add_missing(self, first, last, slow):
+        """
+        Adds a window that has to be asked for again. Windows are asked for again in order of height.
+        :param first: int
+        :param last: int
+        :param slow: Connection - The peer that didn't send it
+        :return: None
+        """
+        self.missing.append([first, last, slow])
+        self.missing.sort(key=lambda m: m[0])
+
+    def check_timeouts(self):
+        """
+        Asks other peers for the requests that haven't been answered in time. Called every second.
+        :return: None
+        """
+        t = time.monotonic()
+        if self.state == 'headers' and t - self.last_request > TIMEOUT:
+            peer = self.peer
+            self.stop(str(peer.id) + " didn't send headers")
+            self.restart(peer)
+
+        elif self.state == 'blocks':
+            for first, r in list(self.requested.items()):
+                if t - r[2] > TIMEOUT:
+                    self.debug_print('Sync: ' + str(r[0].id) + ' is too slow, asking another node for blocks '
+                                     + str(first) + ' to ' + str(r[1]))
+                    del self.requested[first]
+                    self.add_missing(first, r[1], r[0])
+                    self.latency[r[0]] = max(self.latency.get(r[0], 0), TIMEOUT)
+                    self.reassigned += 1
+            self.request_bodies()
+            self.check_sources()
+
+    def peer_disconnected(self, peer):
+        """
+        Asks other peers for the requests that a peer that has disconnected hadn't answered.
+        :param peer: Connection
+        :return: None
+        """
+        if self.state == 'headers' and peer is self.peer:
+            self.stop('node disconnected')
+            self.restart(peer)
+
+        elif self.state == 'blocks':
+            for first, r in list(self.requested.items()):
+                if r[0] is peer:
+                    del self.requested[first]
+                    self.add_missing(first, r[1], peer)
+            self.latency.pop(peer, None)
+            if peer is self.peer:
+                self.peer = None
+            self.request_bodies()
+            self.check_sources()
+
+    def check_sources(self):
+        """
+        Starts again from the headers if no peer that is still connected can send the next block we need, such as when
+        every peer that was sending bodies has disconnected.
+        :return: None
+        """
+        if self.state == 'blocks' and not self.requested and not self.get_peers(self.blockchain.block_height + 1):
+            self.stop('no connected node has the next block')
+            self.restart()
+
+    def finish(self):
+        """
+        Called when every block that the headers were downloaded for has been added.
+        :return: None
+        """
+        self.debug_print('Sync: Added ' + str(len(self.headers)) + ' blocks in {:.1f}s, {} requests reassigned'.format(
+            time.monotonic() - self.started, self.reassigned))
+        self.stop('up to date')
+        self.handler.sync_finished()
+
+    def update_progress(self):
+        """
+        Shows how far through the sync we are on the GUI.
+        :return: None
+        """
+        if self.state == 'headers':
+            progress = 'Headers {}/{}'.format(self.get_tip().height, self.target)
+        elif self.state == 'blocks':
+            progress = 'Blocks {}/{} from {} nodes'.format(self.blockchain.block_height, self.target,
+                                                          len(set(r[0] for r in self.requested.values())))
+        else:
+            progress = 'Up to date'
+        self.handler.GUI.sync_progress = progress
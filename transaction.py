@@ -5,8 +5,7 @@ Transaction object records exchanges of funds between addresses
 from time import time_ns
 from hashlib import sha256
 from Token import Token
-import ecdsa
-import base64
+from verification import verify_signatures
 import copy
 
 
@@ -24,6 +23,7 @@ class Transaction:
         self.hash = self.generate_hash()
         self.txid = self.hash[0:32]
         self.blockchain = blockchain
+        self.leaf_hash = None  # Hash of the transaction in a block's Merkle tree, computed when it is first needed
 
         self.valid = False
 
@@ -257,6 +257,15 @@ class Transaction:
             else:
                 self.debug_print('Transaction: Requirements not met for another Output')
 
+    @staticmethod
+    def get_signing_string(output):
+        """
+        Returns the string form of an output that is signed.
+        :param output: dict
+        :return: string
+        """
+        return str(output['value']) + str(output['recipient']) + str(output['txid']) + str(output['index'])
+
     def get_outputs(self):  # returns string forms of outputs so they can be signed
         """
         Returns the correct string form of outputs so they can be signed.
@@ -265,56 +274,82 @@ class Transaction:
         """
         array = []
         for output in self.outputs:
-            array.append(str(output['value']) + str(output['recipient']) + str(output['txid']) + str(output['index']))
+            array.append(self.get_signing_string(output))
 
         return array  # Returns a list as each output is signed individually.
 
-    def verify(self):
+    def prepare_verification(self):
         """
-        Verifies the transaction.
-        :return: Bool
+        Does every check of the transaction apart from its signatures, and gets the signatures that still have to be
+        checked. The totals, type checks and signing strings all come from one pass over the outputs, so the work grows
+        linearly with the number of outputs.
+        :return: List of (public key, signature, message) tuples, or None if the transaction is invalid
         """
         if self.inputs == [] or self.outputs == []:
             self.debug_print('Transaction(verify): No inputs or outputs')
-            return False
+            return None
 
         if self.from_address == 'blockchain' and self.inputs[0]['value'] == 'Mining Reward' and self.value == self.blockchain.mining_reward:  # needed to allow the passing of mining reward
-            return True
+            return []  # Coinbase transactions aren't signed
         elif self.from_address == 'blockchain':
             self.debug_print('Transaction (verify) Invalid Coinbase Transaction')
-            return False
+            return None
 
-        if self.type == 0 and (self.value > self.get_output_total() or self.get_output_total(True) != self.get_input_total()):
-            self.debug_print('Transaction (verify): Insufficient Funds')
-            return False
-        elif self.type == 1:
-            for o in self.outputs:
-                if o['type'] == 1 and o['value']['voter_address'] != o['recipient']:
-                    self.debug_print('Transaction (verify): Invalid sending of token')
-                    return False
-
-        elif self.type == 2:
+        signatures = []
+        if self.type == 2:
             tk = Token().from_dictionary(self.value)
-            if not tk.verify():
+            if not tk.verify(check_signature=False):  # The token's signature is checked with the outputs'
                 self.debug_print('Transaction (verify): Invalid Token')
-                return False
-
-        try:
-            vk = ecdsa.VerifyingKey.from_string((bytes.fromhex(self.from_address)), curve=ecdsa.SECP256k1)
-            for output in self.outputs:
-                vk.verify(base64.b64decode(output['sig']), self.get_outputs()[output['index']].encode())
+                return None
+            signatures.append(tk.get_signature())
+
+        output_total = 0
+        strings = []  # Signing strings of the outputs, in order of index
+        for o in self.outputs:
+            if o['type'] == 0:
+                output_total += o['value']
+            else:
+                output_total += 1
+                if self.type == 1 and o['type'] == 1 and o['value']['voter_address'] != o['recipient']:
+                    self.debug_print('Transaction (verify): Invalid sending of token')
+                    return None
+            strings.append(self.get_signing_string(o))
 
-            self.debug_print('Transaction (verify): Transaction Verified')
-            return True
+        if self.type == 0 and (self.value > output_total or output_total != self.get_input_total()):
+            self.debug_print('Transaction (verify): Insufficient Funds')
+            return None
 
-        except KeyError:
+        try:
+            for o in self.outputs:
+                signatures.append((self.from_address, o['sig'], strings[o['index']].encode()))
+        except (KeyError, IndexError, TypeError):
             self.debug_print('Transaction (verify): There is no signature')
+            return None
+        return signatures
+
+    def verify(self):
+        """
+        Verifies the transaction.
+        :return: Bool
+        """
+        signatures = self.prepare_verification()
+        if signatures is None:
             return False
+        if not signatures:
+            return True  # Coinbase transaction
 
-        except ecdsa.BadSignatureError:
+        # The blockchain's verifier remembers valid signatures, so they aren't checked again when the block arrives
+        if self.blockchain is not None:
+            valid = self.blockchain.verifier.verify(signatures)
+        else:
+            valid = verify_signatures(signatures)
+        if not valid:
             self.debug_print('Transaction (verify): Bad Signature')
             return False
 
+        self.debug_print('Transaction (verify): Transaction Verified')
+        return True
+
     def get_core_data(self):
         """
         Gets the data that is used to form the TXID.
@@ -322,6 +357,35 @@ class Transaction:
         """
         return str(self.timestamp) + str(self.type) + str(self.from_address) + str(self.to_address)
 
+    def get_block_data(self):
+        """
+        Converts the transaction into the string that is hashed when it is stored in a block.
+        Inputs and Outputs are dictionaries, and just converting the dictionary to a string is bad because the keys are
+        in a random order. This method ensures that the correct string is produced every time.
+        :return: string
+        """
+        self.order_inputs_and_outputs()
+        data = self.get_core_data()
+        for i in self.inputs:
+            data += str(i['txid']) + str(i['value']) + str(i['index']) + str(i['type']) + str(i['recipient']) + str(
+                i['sig'])
+
+        for o in self.outputs:
+            data += str(o['txid']) + str(o['value']) + str(o['index']) + str(o['type']) + str(o['recipient']) + str(
+                o['sig'])
+
+        return data
+
+    def get_leaf_hash(self):
+        """
+        Gets the hash of the transaction that forms a leaf of a block's Merkle tree.
+        The hash is cached, as a transaction isn't changed once it has been signed and added to a block.
+        :return: string
+        """
+        if self.leaf_hash is None:
+            self.leaf_hash = sha256(self.get_block_data().encode()).hexdigest()
+        return self.leaf_hash
+
     def get_dictionary_form(self):
         """
         Returns the dictionary form of the Transaction.
@@ -0,0 +1,108 @@
+"""
+UTXOSet object keeps every unspent output of the blockchain in memory.
+
+Outputs are stored by their (TXID, index), with a secondary index from (recipient, type) to the outputs that they own,
+so balances and coin selection don't need to query the database. The database is still written to whenever a block is
+added, and it is read once when the program starts.
+"""
+
+import threading
+
+
+class UTXOSet:
+    def __init__(self):
+        self.outputs = {}  # (TXID, index) -> output dictionary
+        self.owners = {}  # (recipient, type) -> Dictionary of the (TXID, index) of the outputs that they own
+        self.lock = threading.Lock()  # Blocks are added on the network and mining threads whilst the GUI reads balances
+
+    def __len__(self):
+        return len(self.outputs)
+
+    def __contains__(self, outpoint):
+        return outpoint in self.outputs
+
+    def load(self, outputs):
+        """
+        Fills the set with the unspent outputs that are stored in the database.
+        :param outputs: List of dictionaries
+        :return: None
+        """
+        with self.lock:
+            self.outputs = {}
+            self.owners = {}
+            for o in outputs:
+                self.add(o)
+
+    def add(self, o):
+        """
+        Adds an unspent output. The lock must be held by the caller.
+        :param o: dict
+        :return: None
+        """
+        key = (o['txid'], o['index'])
+        self.outputs[key] = o
+        self.owners.setdefault((o['recipient'], o['type']), {})[key] = None
+
+    def spend(self, txid, index):
+        """
+        Removes an output that has been spent. The lock must be held by the caller.
+        :param txid: string
+        :param index: int
+        :return: None
+        """
+        o = self.outputs.pop((txid, index), None)
+        if o is not None:
+            owned = self.owners[(o['recipient'], o['type'])]
+            del owned[(txid, index)]
+            if not owned:
+                del self.owners[(o['recipient'], o['type'])]
+
+    def connect_block(self, block):
+        """
+        Updates the set with the outputs that a block spends and creates.
+        :param block: Block
+        :return: None
+        """
+        with self.lock:
+            for tx in block.transactions:
+                for i in tx.inputs:
+                    self.spend(i['txid'], i['index'])
+                for o in tx.outputs:
+                    self.add({'txid': o['txid'], 'index': o['index'], 'value': o['value'], 'recipient': o['recipient'],
+                              'sig': o['sig'], 'type': o['type']})
+
+    def get(self, txid, index):
+        """
+        Gets an unspent output.
+        :param txid: string
+        :param index: int
+        :return: dict or None
+        """
+        o = self.outputs.get((txid, index))
+        if o is not None:
+            return dict(o)
+
+    def get_utxos(self, addr, ty):
+        """
+        Gets the unspent outputs of a particular type that belong to an address.
+        Copies are returned, so they can be used as inputs without changing the set.
+        :param addr: string
+        :param ty: int
+        :return: List of dictionaries
+        """
+        with self.lock:
+            return [dict(self.outputs[key]) for key in self.owners.get((addr, ty), {})]
+
+    def get_tokens(self, addr, ty):
+        """
+        Returns the number of tokens of a particular type that an address hasn't spent.
+        Empty tokens (type 0) are counted by their value, other tokens are counted individually.
+        :param addr: string
+        :param ty: int
+        :return: int
+        """
+        with self.lock:
+            owned = self.owners.get((addr, ty), {})
+            if ty == 0:
+                return sum([int(self.outputs[key]['value']) for key in owned])
+            return len(owned)
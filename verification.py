@@ -0,0 +1,151 @@
+"""
+SignatureVerifier object checks the signatures of a block using a pool of worker processes.
+
+Checking an ECDSA signature in pure Python takes milliseconds, and a block of votes has a signature for every output and
+every token. The signatures of a block are collected first, then split into one batch per worker and checked at the
+same time, and the block is only valid if every batch is. Small sets of signatures are checked in this process, as
+sending them to the workers would take longer than checking them.
+
+Valid signatures are remembered, so the signatures of transactions that were checked when they entered the memory pool
+aren't checked again when the block containing them arrives.
+"""
+
+import base64
+import binascii
+import concurrent.futures
+import functools
+import multiprocessing
+import os
+from hashlib import sha256
+
+import ecdsa
+
+from cache import SeenCache
+
+
+@functools.lru_cache(maxsize=1024)
+def get_verifying_key(public_key):
+    """
+    Decompresses a public key. The transactions and tokens of a voter are all signed with the same key, so the keys
+    are cached rather than decompressed for every signature.
+    :param public_key: string - Compressed public key in hex, as used for addresses
+    :return: VerifyingKey
+    """
+    return ecdsa.VerifyingKey.from_string(bytes.fromhex(public_key), curve=ecdsa.SECP256k1)
+
+
+def verify_signature(public_key, sig, message):
+    """
+    Checks a signature.
+    :param public_key: string - Compressed public key in hex, as used for addresses
+    :param sig: string or bytes - Base64 encoded signature
+    :param message: bytes - Data that was signed
+    :return: Bool
+    """
+    try:
+        return get_verifying_key(public_key).verify(base64.b64decode(sig), message)
+    except (ecdsa.BadSignatureError, ecdsa.errors.MalformedPointError, binascii.Error, ValueError, TypeError):
+        return False
+
+
+def get_cache_key(public_key, sig, message):
+    """
+    Gets the key that a valid signature is stored under in the cache. The message is hashed so the cache stays
+    small, and the signature is always bytes, as signatures received from other nodes are strings.
+    :param public_key: string
+    :param sig: string or bytes - Base64 encoded signature
+    :param message: bytes
+    :return: tuple
+    """
+    return public_key, sha256(message).digest(), sig if isinstance(sig, bytes) else str(sig).encode()
+
+
+def verify_signatures(signatures):
+    """
+    Checks a batch of signatures. Run by the worker processes.
+    :param signatures: List of (public key, signature, message) tuples
+    :return: Bool - True if every signature is valid
+    """
+    for public_key, sig, message in signatures:
+        if not verify_signature(public_key, sig, message):
+            return False
+    return True
+
+
+class SignatureVerifier:
+    def __init__(self, workers=None, min_batch=8, cache_size=100000):
+        self.workers = workers if workers is not None else os.cpu_count() or 1
+        self.min_batch = min_batch  # Fewer signatures than this are checked without the workers
+        self.pool = None  # Started when it is first needed
+        # Signatures that are known to be valid. They stay valid, so they are only forgotten when the cache is full
+        self.cache = SeenCache(cache_size, None) if cache_size else None
+
+    def start(self):
+        """
+        Starts the worker processes if they are not already running.
+        :return: None
+        """
+        if self.pool is None:
+            # Spawn avoids forking the threads of the GUI and the network into every worker
+            self.pool = concurrent.futures.ProcessPoolExecutor(self.workers,
+                                                               mp_context=multiprocessing.get_context('spawn'))
+
+    def verify(self, signatures):
+        """
+        Checks a set of signatures, such as every signature in a block.
+        :param signatures: List of (public key, signature, message) tuples
+        :return: Bool - True if every signature is valid
+        """
+        if self.cache is not None:
+            unchecked = {}  # Cache key -> Signature, for the signatures that haven't been checked before
+            for s in signatures:
+                key = get_cache_key(*s)
+                if not self.cache.check(key):
+                    unchecked[key] = s
+            signatures = list(unchecked.values())
+            if not signatures:
+                return True
+
+        if self.check(signatures):
+            if self.cache is not None:
+                for key in unchecked:
+                    self.cache.add(key)
+            return True
+        return False
+
+    def check(self, signatures):
+        """
+        Checks signatures without the cache, in the worker processes if there are enough of them.
+        :param signatures: List of (public key, signature, message) tuples
+        :return: Bool - True if every signature is valid
+        """
+        if self.workers <= 1 or len(signatures) < self.min_batch:
+            return verify_signatures(signatures)
+
+        self.start()
+        size = -(-len(signatures) // self.workers)  # Rounded up, so there is at most one batch per worker
+        batches = [signatures[i:i + size] for i in range(0, len(signatures), size)]
+        futures = [self.pool.submit(verify_signatures, batch) for batch in batches]
+        valid = True
+        for future in futures:
+            if not future.result():
+                valid = False
+        return valid
+
+    def get_stats(self):
+        """
+        Gets how well the signature cache is working. Used for displaying information in the UI.
+        :return: dict
+        """
+        if self.cache is None:
+            return {'size': 0, 'hits': 0, 'misses': 0, 'hit_rate': 0.0}
+        return self.cache.get_stats()
+
+    def shutdown(self):
+        """
+        Stops the worker processes.
+        :return: None
+        """
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+            self.pool = None